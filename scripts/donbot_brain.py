@@ -21,7 +21,8 @@ from refills_msgs.msg._ScanningAction import ScanningAction
 from refills_msgs.msg._ScanningGoal import ScanningGoal
 from std_msgs.msg import Header
 
-from refills_first_review.knowrob_wrapper import KnowRob
+from refills_first_review.futures import Worker
+from refills_first_review.knowrob_wrapper import KnowRob, ActionGraph
 from refills_first_review.move_arm import GiskardWrapper
 from refills_first_review.move_base import MoveBase
 from refills_first_review.robosherlock_wrapper import RoboSherlock
@@ -71,12 +72,23 @@ class CRAM(object):
         # TODO use paramserver [low]
         self._as = SimpleActionServer(ACTION_NAME, ScanningAction, execute_cb=self.action_cb, auto_start=False)
         self._as.register_preempt_callback(self.preempt_cb)
-        self.knowrob = KnowRob()
+        self.knowrob = KnowRob(async_action_logging=rospy.get_param('~async_action_logging', False),
+                               prolog_pool_size=rospy.get_param('~prolog_pool_size', 4),
+                               record_path=rospy.get_param('~prolog_record', None),
+                               replay_path=rospy.get_param('~prolog_replay', None),
+                               replay_latency=rospy.get_param('~prolog_replay_latency', 0.),
+                               replay_time_scale=rospy.get_param('~prolog_replay_time_scale', 0.),
+                               static_shelf_frames=rospy.get_param('~static_shelf_frames', False))
         self.robosherlock = RoboSherlock(self.knowrob)
         self.move_base = MoveBase(enabled=True, knowrob=self.knowrob)
         self.move_arm = GiskardWrapper(enabled=True, knowrob=self.knowrob)
         self.map_frame_id = rospy.get_param('~/map', 'map')
         self.tf = TfWrapper()
+        # if True, the arm already moves to the counting pose while the shelf parts of a floor are clustered
+        # and added to knowrob. The counting pose then uses the floor height from before the scan.
+        self.async_detection = rospy.get_param('~async_detection', False)
+        self.shelf_parts_worker = Worker('shelf parts')
+        self.shelf_parts = None
 
     def start(self):
         self.knowrob.start_everything()
@@ -115,9 +127,10 @@ class CRAM(object):
                 os.makedirs(episode_dir)
                 self.knowrob.save_beliefstate(episode_dir+'/beliefstate.owl')
                 self.knowrob.save_action_graph(episode_dir+'/actions.owl')
+                self.knowrob.save_prolog_stats(episode_dir+'/prolog_stats.json')
                 rospy.loginfo('logs exported')
                 # self.mongo_save(episode_dir)
-            except OSError as exc:  # Python >2.5
+            except (OSError, IOError) as exc:  # Python >2.5
                 rospy.logwarn('failed to export logs, IO error')
             #self.knowrob.save_beliefstate()
             #self.knowrob.save_action_graph()
@@ -247,13 +260,53 @@ class CRAM(object):
             self.move_base.STOP()
 
 
-        barcodes = self.robosherlock.stop_barcode_detection()
-        if not self.knowrob.is_hanging_foor(floor_id):
-            separators = self.robosherlock.stop_separator_detection()
-            self.knowrob.add_separators_and_barcodes(floor_id, separators, barcodes)
+        hanging = self.knowrob.is_hanging_foor(floor_id)
+        barcodes = self.robosherlock.stop_barcode_detection_async()
+        shelf_parts = self.robosherlock.stop_separator_detection_async()
+        # the perception events belong to the move to the shelf frame end, which is the current action,
+        # and are logged at the time the detection stopped, also if the shelf parts are added later
+        self.shelf_parts = (floor_id, hanging,
+                            self.shelf_parts_worker.submit(self.add_shelf_parts, floor_id, hanging, shelf_parts,
+                                                           barcodes),
+                            self.knowrob.action_graph, ActionGraph.unix_time_seconds())
+        if self.async_detection:
+            self.finish_scan_actions()
+        else:
+            self.finish_scan_floor()
+
+    def add_shelf_parts(self, floor_id, hanging, shelf_parts, barcodes):
+        """
+        :param shelf_parts: Future of the separators or mounting bars
+        :param barcodes: Future of the barcodes
+        """
+        if not hanging:
+            self.knowrob.add_separators_and_barcodes(floor_id, shelf_parts.result(), barcodes.result(),
+                                                     log_perception=False)
+        else:
+            self.knowrob.add_mounting_bars_and_barcodes(floor_id, shelf_parts.result(), barcodes.result(),
+                                                        log_perception=False)
+
+    def finish_scan_floor(self):
+        """
+        Waits until the shelf parts of the last scanned floor are in knowrob and logs their perception.
+        In synchronous mode, the scanning actions are finished afterwards, otherwise scan_floor has finished them.
+        """
+        if self.shelf_parts is None:
+            return
+        floor_id, hanging, future, action, t = self.shelf_parts
+        self.shelf_parts = None
+        future.result()
+        if not hanging:
+            self.knowrob.log_separator_perception(floor_id, action, t)
         else:
-            mounting_bars = self.robosherlock.stop_separator_detection()
-            self.knowrob.add_mounting_bars_and_barcodes(floor_id, mounting_bars, barcodes)
+            self.knowrob.log_mounting_bar_perception(floor_id, action, t)
+        if not self.async_detection:
+            self.finish_scan_actions()
+
+    def finish_scan_actions(self):
+        """
+        Finishes moving to the shelf frame end, looking at the floor and finding its parts.
+        """
         self.knowrob.finish_action()
         self.knowrob.finish_action()
         self.knowrob.finish_action()
@@ -281,29 +334,27 @@ class CRAM(object):
 
     def count_floor(self, shelf_id, floor_id):
         rospy.loginfo('counting objects on floor {}'.format(floor_id))
+        if self.async_detection:
+            self.move_to_counting_pose(floor_id)
+            self.finish_scan_floor()
         self.knowrob.start_shelf_layer_counting()
         facings = self.knowrob.get_facings(floor_id)
-        goal = deepcopy(COUNTING_OFFSET)
-        goal.header.frame_id = self.knowrob.get_perceived_frame_id(floor_id)
-        if self.knowrob.is_hanging_foor(floor_id):
-            # TODO magic offset
-            goal.pose.position.z = -goal.pose.position.z + 0.05
-        goal = self.tf.transform_pose(self.move_arm.root, goal)
-        goal.pose.position.x = COUNTING_OFFSET2
-        self.move_arm.set_and_send_cartesian_goal(goal)
+        if not self.async_detection:
+            self.move_to_counting_pose(floor_id)
         if len(facings) == 0:
             self.move_base.move_relative([self.knowrob.get_floor_width(), 0, 0])
         else:
+            gripper_in_base = self.tf.lookup_async(self.move_arm.root, self.move_arm.tip)
             frame_id = self.knowrob.get_perceived_frame_id(shelf_id)
-            gripper_in_base = self.tf.lookup_transform(self.move_arm.root, self.move_arm.tip)
-            for i, (facing_id, (facing_pose, product, width, left_sep)) in enumerate(
-                    reversed(sorted(facings.items(), key=lambda (k, v): v[0].pose.position.x))):
+            gripper_in_base = gripper_in_base.result()
+            for i, (facing_id, facing_position, product, width, left_sep) in enumerate(
+                    facings.sorted_by_x(reverse=True)):
                 if i != 0:
                     self.knowrob.start_shelf_layer_counting()
 
                 try:
                     self.move_base.move_absolute_xyz(frame_id,
-                                                     gripper_in_base.pose.position.x + facing_pose.pose.position.x,
+                                                     gripper_in_base.pose.position.x + facing_position[0],
                                                      FLOOR_SCANNING_OFFSET['y'],
                                                      FLOOR_SCANNING_OFFSET['z'])
                 except TimeoutError as e:
@@ -312,12 +363,22 @@ class CRAM(object):
 
                 facing_type = 'hanging' if self.knowrob.is_hanging_foor(floor_id) else 'standing'
                 count = self.robosherlock.count(product, width, left_sep, self.knowrob.get_perceived_frame_id(shelf_id), facing_type)
-                for j in range(count):
-                    self.knowrob.add_object(facing_id)
                 rospy.loginfo('counted {} objects in facing {}'.format(count, facing_id))
+                # spawned within the counting action, such that they are tied to it in the action graph
+                self.knowrob.add_objects({facing_id: count})
                 self.knowrob.finish_action()
 
 
+    def move_to_counting_pose(self, floor_id):
+        goal = deepcopy(COUNTING_OFFSET)
+        goal.header.frame_id = self.knowrob.get_perceived_frame_id(floor_id)
+        if self.knowrob.is_hanging_foor(floor_id):
+            # TODO magic offset
+            goal.pose.position.z = -goal.pose.position.z + 0.05
+        goal = self.tf.transform_pose(self.move_arm.root, goal)
+        goal.pose.position.x = COUNTING_OFFSET2
+        self.move_arm.set_and_send_cartesian_goal(goal)
+
     def STOP(self):
         self.move_base.STOP()
         self.move_arm.client.cancel_goal()
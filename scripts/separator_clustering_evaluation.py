@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+import json
+import os
+import sys
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+from refills_first_review.interval_clustering import IntervalClustering
+
+# max difference of two separator positions in m that are considered the same
+TOLERANCE = 1e-6
+
+
+def dbscan(data, weights, max_dist, min_samples):
+    clusters = DBSCAN(eps=max_dist, min_samples=min_samples).fit(data, sample_weight=weights)
+    centers = []
+    for label in np.unique(clusters.labels_):
+        if label != -1:
+            mask = clusters.labels_ == label
+            centers.append(np.average(data[mask], axis=0, weights=weights[mask]))
+    return np.array(sorted(centers, key=lambda x: x[0])).reshape(-1, 3)
+
+
+def interval_clustering(data, weights, max_dist, min_samples):
+    clustering = IntervalClustering(max_dist, min_samples)
+    for position, weight in zip(data, weights):
+        clustering.add(position, weight)
+    return np.array([position for position, _ in clustering.get_clusters()]).reshape(-1, 3)
+
+
+def compare(a, b):
+    """
+    :return: max distance between the x coordinates of matching clusters, inf if the number of clusters differs
+    """
+    if len(a) != len(b):
+        return np.inf
+    if len(a) == 0:
+        return 0.
+    return np.abs(a[:, 0] - b[:, 0]).max()
+
+
+def evaluate(path):
+    """
+    Compares IntervalClustering with DBSCAN on detections recorded with ~separator_detections_path.
+    IntervalClustering has to match DBSCAN on the x coordinates exactly,
+    the difference to DBSCAN on the full positions is only reported.
+    """
+    equivalent = True
+    for i, line in enumerate(open(path)):
+        if line.strip() == '':
+            continue
+        floor = json.loads(line)
+        data = np.array(floor['detections'], dtype=float).reshape(-1, 3)
+        weights = np.array(floor['weights'], dtype=float)
+        if len(data) == 0:
+            continue
+        max_dist, min_samples = floor['max_dist'], floor['min_samples']
+        online = interval_clustering(data, weights, max_dist, min_samples)
+        x_only = data.copy()
+        x_only[:, 1:] = 0
+        reference = dbscan(x_only, weights, max_dist, min_samples)
+        full = dbscan(data, weights, max_dist, min_samples)
+        error = compare(online, reference)
+        equivalent &= error <= TOLERANCE
+        print('{}: {} detections, online: {} separators, dbscan on x: {} (max error {}), '
+              'dbscan on xyz: {} (max error {})'.format(floor['floor_id'], len(data), len(online), len(reference),
+                                                        error, len(full), compare(online, full)))
+    return equivalent
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        print('usage: separator_clustering_evaluation.py [separator detections file]')
+        sys.exit(2)
+    if len(sys.argv) == 2:
+        path = sys.argv[1]
+    else:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'data',
+                            'synthetic_separator_detections.json')
+    if evaluate(path):
+        print('online clustering matches dbscan on x')
+    else:
+        print('online clustering differs from dbscan on x')
+        sys.exit(1)
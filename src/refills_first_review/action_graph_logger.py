@@ -0,0 +1,105 @@
+import traceback
+from Queue import Queue, Empty
+from threading import Thread
+
+import rospy
+
+
+class ActionGraphLogger(object):
+    """
+    Sends the queries of an ActionGraph to KnowRob.
+    In asynchronous mode the queries are queued and submitted in batches by a background thread, such that
+    logging never blocks the caller. The order of the queries is preserved.
+    """
+    def __init__(self, knowrob, asynchronous=False, batch_size=20):
+        self.knowrob = knowrob
+        self.asynchronous = asynchronous
+        self.batch_size = batch_size
+        self.queue = Queue()
+        if self.asynchronous:
+            self.worker = Thread(target=self.run, name='action_graph_logger')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def log(self, query, node=None):
+        """
+        :param query: function(ref, var) that returns a prolog goal. ref(node) returns the id of an ActionGraph node,
+                      var is the name of the variable that the goal has to bind to the id of node.
+        :param node: the ActionGraph node created by query, None if query does not create a node
+        """
+        if self.asynchronous:
+            self.queue.put((query, node))
+        else:
+            self.execute([(query, node)])
+
+    def flush(self):
+        """
+        Blocks until all queued queries have been submitted.
+        """
+        if self.asynchronous:
+            self.queue.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self.execute(batch)
+            except Exception:
+                rospy.logerr('failed to log action graph batch:\n{}'.format(traceback.format_exc()))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def execute(self, batch):
+        variables = {}
+        used_variables = set()
+
+        def ref(node):
+            if node in variables:
+                used_variables.add(variables[node])
+                return variables[node]
+            if node.id is None:
+                raise MissingId(node)
+            return node.id
+
+        goals = []
+        executed = []
+        for query, node in batch:
+            var = 'R{}'.format(len(goals))
+            used_variables.clear()
+            try:
+                goal = query(ref, var)
+            except MissingId:
+                rospy.logwarn('skipped an action graph query, it refers to a node that could not be logged')
+                continue
+            if used_variables:
+                # the variable of a node whose goal failed earlier in this batch stays unbound,
+                # goals that refer to it fail instead of using a free variable
+                goal = '{}, ({})'.format(', '.join('nonvar({})'.format(v) for v in sorted(used_variables)), goal)
+            if node is not None:
+                variables[node] = var
+            goals.append(goal)
+            executed.append(node)
+        if len(goals) == 0:
+            return
+        solution, successes = self.knowrob.prolog_batch(goals)
+        if solution is None:
+            rospy.logwarn('failed to log a batch of {} queries'.format(len(goals)))
+            return
+        for goal, node, success in zip(goals, executed, successes):
+            if not success:
+                rospy.logwarn('failed to log {}'.format(goal))
+            elif node is not None:
+                node.id = solution[variables[node]]
+
+
+class MissingId(Exception):
+    """
+    Raised by ref if a node is neither logged in the current batch nor has an id, because logging it failed.
+    """
+    pass
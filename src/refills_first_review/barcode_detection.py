@@ -1,27 +1,42 @@
 from __future__ import division
 
-import json
+import traceback
+from Queue import Queue, Full, Empty
 from random import choice, sample
 from simplejson import OrderedDict
+from threading import Thread, Lock
+from time import time
 
 import rospy
 import numpy as np
 
-from copy import deepcopy
-
 from collections import defaultdict
-from geometry_msgs.msg import Point, Vector3, PoseStamped, Quaternion, Pose
+from geometry_msgs.msg import Vector3, Quaternion
 from refills_msgs.msg import Barcode
 from rospy import ROSException
 from std_msgs.msg import ColorRGBA, Header
 from tf.transformations import quaternion_from_matrix, quaternion_from_euler
 from tf2_msgs.msg import TFMessage
-from visualization_msgs.msg import Marker, MarkerArray
-from rospkg import RosPack
+from visualization_msgs.msg import Marker
+from refills_first_review.barcode_validation import BarcodeValidator
+from refills_first_review.catalog import get_catalog
+from refills_first_review.deferred_transformer import DeferredTransformer
+from refills_first_review.marker_manager import get_marker_manager
+from refills_first_review.poses import Pose
+from refills_first_review.running_stats import RunningPosition
 from refills_first_review.tfwrapper import TfWrapper
 
 MAP = 'map'
 
+# max number of barcode messages waiting for the worker, further messages are dropped
+QUEUE_SIZE = 1000
+# max number of messages that are transformed together
+BATCH_SIZE = 50
+# max seconds a message waits for its transform, it is dropped afterwards
+TRANSFORM_DEADLINE = 0.5
+# max seconds stop_receiving waits for the worker to empty the queue
+STOP_TIMEOUT = 2.
+
 
 class BarcodeDetector(object):
     def __init__(self, knowrob):
@@ -31,7 +46,7 @@ class BarcodeDetector(object):
         self.shelf_width = 1
 
         self.tf = TfWrapper(4)
-        self.marker_pub = rospy.Publisher('visualization_marker_array', MarkerArray, queue_size=10)
+        self.markers = get_marker_manager()
         self.marker_object_ns = 'barcode_object'
         self.marker_text_ns = 'barcode_text'
 
@@ -43,21 +58,72 @@ class BarcodeDetector(object):
         self.object_scale = Vector3(.05, .05, .05)
         self.text_scale = Vector3(0, 0, .05)
         self.listen = False
+        # only accept barcodes from the product catalog
+        if rospy.get_param('~barcode_allow_list', False):
+            self.validator = BarcodeValidator(set(self.barcode_to_mesh.keys()))
+        else:
+            self.validator = BarcodeValidator()
+        self.queue = Queue(QUEUE_SIZE)
+        self.transformer = DeferredTransformer(self.tf, 'barcode detection', self.add_positions,
+                                               deadline=TRANSFORM_DEADLINE, via=MAP)
+        self.stats_lock = Lock()
+        self.reset_stats()
+        self.worker = Thread(target=self.run, name='barcode_detection')
+        self.worker.daemon = True
+        self.worker.start()
         self.sub = rospy.Subscriber(self.detector_topic, Barcode, self.cb, queue_size=100)
 
     def load_barcode_to_mesh_map(self):
-        self.barcode_to_mesh = json.load(open(RosPack().get_path('refills_first_review')+'/data/barcode_to_mesh.json'))
+        self.barcode_to_mesh = get_catalog()
 
     def start_listening(self, shelf_id, floor_id):
         self.shelf_id = shelf_id
         self.floor_id = floor_id
-        self.barcodes = defaultdict(list)
+        self.barcode_stats = defaultdict(RunningPosition)
+        self.barcodes = OrderedDict()
+        self.confidences = {}
+        self.floor_frame_id = self.knowrob.get_perceived_frame_id(floor_id)
+        self.tf.add_static_frame(self.floor_frame_id)
+        self.transformer.reset_stats()
+        self.reset_stats()
         self.listen = True
         # self.sub = rospy.Subscriber(self.detector_topic, Barcode, self.cb, queue_size=100)
 
     def stop_listening(self):
+        self.stop_receiving()
+        return self.process_detections()
+
+    def stop_receiving(self):
+        """
+        Stops adding barcodes. Returns once all received barcodes are transformed or dropped,
+        or after STOP_TIMEOUT if the worker can not keep up.
+        """
         # self.sub.unregister()
         self.listen = False
+        self.wait_for_queue(STOP_TIMEOUT)
+        self.transformer.flush()
+        self.transformer.log_stats()
+        self.log_stats()
+
+    def wait_for_queue(self, timeout):
+        """
+        Like Queue.join, but gives up after timeout seconds.
+        """
+        deadline = time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks > 0:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    rospy.logwarn('barcode detection: {} messages are still queued'.format(
+                        self.queue.unfinished_tasks))
+                    return
+                self.queue.all_tasks_done.wait(remaining)
+
+    def process_detections(self):
+        """
+        :return: dict barcode -> Pose, in the perceived frame of the floor.
+                 The confidence of each barcode is in self.confidences.
+        """
         try:
             rospy.wait_for_message('/refills_wrist_camera/image_color', rospy.AnyMsg, timeout=1)
         except ROSException as e:
@@ -70,48 +136,120 @@ class BarcodeDetector(object):
 
     def detect_fake_barcodes(self):
         num_of_barcodes = 14
-        frame_id = self.knowrob.get_perceived_frame_id(self.floor_id)
         barcodes = sample(self.barcode_to_mesh.keys(), num_of_barcodes)
         for i in range(num_of_barcodes):
             barcode = barcodes[i]
-            p = PoseStamped()
-            p.header.frame_id = frame_id
-            p.pose.position.x = (i + .5) / (num_of_barcodes)
-            p.pose.position.y = 0
-            p.pose.orientation = Quaternion(0, 0, 0, 1)
-            self.barcodes[barcode].append(p)
+            self.barcode_stats[barcode].add([(i + .5) / (num_of_barcodes), 0., 0.])
 
     def cluster(self):
         frame_id = self.knowrob.get_perceived_frame_id(self.floor_id)
-        for barcode, poses in self.barcodes.items():
-            positions = [[p.pose.position.x, p.pose.position.y, p.pose.position.z] for p in poses]
-            position = np.mean(positions, axis=0)
-            p = PoseStamped()
-            p.header.frame_id = frame_id
-            p.pose.position = Point(*position)
-            p.pose.orientation.w = 1
-            self.barcodes[barcode] = p
+        for barcode, stats in self.barcode_stats.items():
+            self.barcodes[barcode] = Pose(frame_id, stats.position())
+            self.confidences[barcode] = stats.confidence()
+            rospy.logdebug('barcode {} seen {} times, spread {:.3f}m, confidence {:.2f}'.format(
+                barcode, stats.count, stats.spread(), self.confidences[barcode]))
 
     def cb(self, data):
         if self.listen:
-            p = self.tf.transform_pose(MAP, data.barcode_pose)
-            if p is not None:
-                p.header.stamp = rospy.Time()
-                p = self.tf.transform_pose(self.knowrob.get_perceived_frame_id(self.floor_id), p)
-                if p.pose.position.x > 0.0 and p.pose.position.x < 1.0:
-                    self.barcodes[data.barcode[1:-1]].append(p)
+            code = self.validator.validate(data.barcode)
+            if code is None:
+                return
+            try:
+                self.queue.put_nowait((code, data.barcode_pose))
+            except Full:
+                with self.stats_lock:
+                    self.dropped += 1
+                return
+            with self.stats_lock:
+                self.received += 1
+                self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            start = time()
+            try:
+                self.add_barcodes(batch)
+            except Exception:
+                rospy.logerr('failed to process barcodes:\n{}'.format(traceback.format_exc()))
+            finally:
+                with self.stats_lock:
+                    self.batches += 1
+                    self.processed += len(batch)
+                    self.busy_time += time() - start
+                for _ in batch:
+                    self.queue.task_done()
+
+    def add_barcodes(self, batch):
+        """
+        Hands a batch of barcodes to the transformer, which parks it until its transforms are available,
+        such that the worker never waits for tf.
+        :param batch: list of (product code, PoseStamped)
+        """
+        self.transformer.add(self.floor_frame_id, [pose for _, pose in batch], [code for code, _ in batch])
+
+    def add_positions(self, batch, codes):
+        """
+        Adds transformed barcodes to the barcode statistics.
+        :type batch: refills_first_review.poses.PoseBatch
+        :param codes: product code of every row of batch
+        """
+        failed = 0
+        for code, position in zip(codes, batch.positions):
+            if not np.isfinite(position[0]):
+                failed += 1
+            elif 0.0 < position[0] < 1.0:
+                self.barcode_stats[code].add(position)
+        with self.stats_lock:
+            self.failed += failed
+
+    def reset_stats(self):
+        self.validator.reset_stats()
+        with self.stats_lock:
+            self.received = 0
+            self.processed = 0
+            self.dropped = 0
+            self.failed = 0
+            self.batches = 0
+            self.max_queue_depth = 0
+            self.busy_time = 0.
+
+    def get_stats(self):
+        """
+        :return: dict with the number of received, processed, dropped and not transformable messages,
+                 the current and max queue depth, the mean batch size, the throughput of the worker in messages/s
+                 and the number of invalid barcodes per reason
+        """
+        with self.stats_lock:
+            return {'received': self.received,
+                    'rejected': self.validator.get_stats()['rejected'],
+                    'processed': self.processed,
+                    'dropped': self.dropped,
+                    'failed': self.failed,
+                    'queue_depth': self.queue.qsize(),
+                    'max_queue_depth': self.max_queue_depth,
+                    'batch_size': self.processed / max(self.batches, 1),
+                    'throughput': self.processed / self.busy_time if self.busy_time > 0 else 0.}
+
+    def log_stats(self):
+        rospy.loginfo('barcode detection: {received} messages received, {rejected} rejected, {dropped} dropped, '
+                      '{failed} not transformed, '
+                      'max queue depth {max_queue_depth}, mean batch size {batch_size:.1f}, '
+                      'throughput {throughput:.0f} messages/s'.format(**self.get_stats()))
 
     def publish_as_marker(self):
-        ma = MarkerArray()
+        texts = {}
         frame_id = self.knowrob.get_perceived_frame_id(self.floor_id)
         for i, (barcode, pose) in enumerate(self.barcodes.items()):
             # object
             m = Marker()
             m.header.frame_id = frame_id
-            m.ns = self.marker_object_ns
-            m.id = int(barcode)
-            m.action = Marker.ADD
-            m.pose = deepcopy(pose.pose)
+            m.pose = pose.to_msg().pose
             try:
                 mesh_path = self.barcode_to_mesh[str(barcode)]
             except KeyError as e:
@@ -130,23 +268,19 @@ class BarcodeDetector(object):
                 m.color = ColorRGBA(0, 0, 0, 0)
                 m.mesh_use_embedded_materials = True
             # if mesh_path != '':
-            #     ma.markers.append(m)
+            #     objects[int(barcode)] = m
 
             # text
             m = Marker()
             m.header.frame_id = frame_id
-            m.ns = self.marker_text_ns
-            m.id = int(barcode)
             m.type = Marker.TEXT_VIEW_FACING
-            m.action = Marker.ADD
             m.text = barcode
             m.scale = self.text_scale
             m.color = self.text_color
-            m.pose = deepcopy(pose.pose)
+            m.pose = pose.to_msg().pose
             m.pose.position.z += 0.07
-            ma.markers.append(m)
-        if len(ma.markers) > 0:
-            self.marker_pub.publish(ma)
+            texts[int(barcode)] = m
+        self.markers.set('{}_{}'.format(self.marker_text_ns, self.floor_id), texts)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+from collections import defaultdict
+from threading import Lock
+
+# the detector reports EAN-8 codes, a leading 0, 6 digits that identify the product and a check digit
+BARCODE_LENGTH = 8
+DIGITS = frozenset('0123456789')
+
+# reject reasons
+LENGTH = 'length'
+FORMAT = 'format'
+CHECK_DIGIT = 'check_digit'
+UNKNOWN = 'unknown'
+
+
+def ean_check_digit(digits):
+    """
+    :param digits: string of the digits without the check digit
+    :return: the check digit as int
+    """
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        total += int(digit) * (3 if i % 2 == 0 else 1)
+    return (10 - total % 10) % 10
+
+
+class BarcodeValidator(object):
+    """
+    Rejects misread barcodes before they are transformed.
+    """
+    def __init__(self, allowed=None):
+        """
+        :param allowed: set of product codes, i.e. the 6 digits without leading 0 and check digit,
+                        that can be detected. None to accept every code with a valid check digit.
+        """
+        self.allowed = allowed
+        self.lock = Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.accepted = 0
+            self.rejected = defaultdict(int)
+
+    def get_stats(self):
+        """
+        :return: dict with the number of accepted codes and the number of rejected codes per reason
+        """
+        with self.lock:
+            return {'accepted': self.accepted,
+                    'rejected': dict(self.rejected)}
+
+    def reject_reason(self, barcode):
+        """
+        :param barcode: code as reported by the detector
+        :return: None if barcode is valid, otherwise the reason why it is not
+        """
+        if len(barcode) != BARCODE_LENGTH:
+            return LENGTH
+        if not DIGITS.issuperset(barcode):
+            return FORMAT
+        if ean_check_digit(barcode[:-1]) != int(barcode[-1]):
+            return CHECK_DIGIT
+        if self.allowed is not None and barcode[1:-1] not in self.allowed:
+            return UNKNOWN
+        return None
+
+    def validate(self, barcode):
+        """
+        :param barcode: code as reported by the detector
+        :return: product code of barcode, None if it was rejected
+        """
+        reason = self.reject_reason(barcode)
+        with self.lock:
+            if reason is not None:
+                self.rejected[reason] += 1
+                return None
+            self.accepted += 1
+        return barcode[1:-1]
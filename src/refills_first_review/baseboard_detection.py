@@ -5,16 +5,18 @@ from simplejson import OrderedDict
 import rospy
 import numpy as np
 
-from copy import deepcopy
 
 from collections import defaultdict
-from geometry_msgs.msg import Point, Vector3, PoseStamped, Quaternion, Pose
+from geometry_msgs.msg import Point, Vector3, PoseStamped, Quaternion
 from rospy import ROSException
 from std_msgs.msg import ColorRGBA, Header
 from tf.transformations import quaternion_from_matrix, quaternion_from_euler, quaternion_about_axis
 from tf2_msgs.msg import TFMessage
-from visualization_msgs.msg import Marker, MarkerArray
+from visualization_msgs.msg import Marker
 
+from refills_first_review.deferred_transformer import DeferredTransformer
+from refills_first_review.marker_manager import get_marker_manager
+from refills_first_review.poses import Pose
 from refills_first_review.tfwrapper import TfWrapper
 
 MAP = 'map'
@@ -64,11 +66,7 @@ class Shelf(object):
         return np.mean(self.right_measurements, axis=0)
 
     def get_shelf(self):
-        p = PoseStamped()
-        p.header.frame_id = MAP
-        p.pose.position = Point(*self.calc_shelf_origin())
-        p.pose.orientation = Quaternion(*self.get_orientation())
-        return self.get_name(), p
+        return self.get_name(), Pose(MAP, self.calc_shelf_origin(), self.get_orientation())
 
     def calc_shelf_origin(self):
         left = self.get_left()
@@ -106,10 +104,11 @@ class BaseboardDetector(object):
         self.shelf_width = 1
 
         self.tf = TfWrapper()
-        self.marker_pub = rospy.Publisher('visualization_marker_array', MarkerArray, queue_size=10)
+        self.markers = get_marker_manager()
         self.marker_ns = 'baseboard_marker'
 
         self.shelves = []
+        self.transformer = DeferredTransformer(self.tf, 'baseboard detection', self.add_measurements)
         self.baseboard_detector_topic = '/ros_markers/tf'
         # try:
         #     rospy.wait_for_message('/refills_wrist_camera/image_color', rospy.AnyMsg, timeout=1)
@@ -122,10 +121,13 @@ class BaseboardDetector(object):
 
     def start_listening(self):
         self.shelves = []
+        self.transformer.reset_stats()
         self.detector_sub = rospy.Subscriber(self.baseboard_detector_topic, TFMessage, self.cb, queue_size=10)
 
     def stop_listening(self):
         self.detector_sub.unregister()
+        self.transformer.flush()
+        self.transformer.log_stats()
         # self.publish_as_marker()
         return OrderedDict([x.get_shelf() for x in self.shelves if x.is_complete()])
 
@@ -148,17 +150,22 @@ class BaseboardDetector(object):
             self.shelves.append(s4)
 
     def cb(self, data):
+        poses = []
         for msg in data.transforms:
-            number = int(msg.child_frame_id.split('_')[-1])
             pose = PoseStamped()
             pose.header = msg.header
             pose.pose.position = Point(msg.transform.translation.x,
                                        msg.transform.translation.y,
                                        msg.transform.translation.z)
             pose.pose.orientation.w = 1
-            pose = self.tf.transform_pose(MAP, pose)
-            if pose is not None:
-                position = [pose.pose.position.x, pose.pose.position.y, pose.pose.position.z]
+            poses.append(pose)
+        numbers = [int(msg.child_frame_id.split('_')[-1]) for msg in data.transforms]
+        self.transformer.add(MAP, poses, numbers)
+
+    def add_measurements(self, batch, numbers):
+        for number, position in zip(numbers, batch.positions):
+            if np.isfinite(position[0]):
+                position = position.tolist()
                 for shelf in self.shelves:
                     if shelf.add_measurement(number, position):
                         break
@@ -167,45 +174,38 @@ class BaseboardDetector(object):
 
     def publish_as_marker(self):
         # TODO use current frame id
-        ma = MarkerArray()
+        markers = {}
         for i, shelf in enumerate(self.shelves):
             if shelf.is_complete():
                 # shelf
                 m = Marker()
                 m.header.frame_id = shelf.get_name()
-                m.ns = self.marker_ns
-                m.id = i
                 m.pose.orientation = Quaternion(*quaternion_about_axis(-np.pi/2, [0,0,1]))
                 if shelf.id == 0:
                     m.pose.position.y -= 0.07
-                m.action = Marker.ADD
                 m.type = Marker.MESH_RESOURCE
                 m.mesh_resource = 'package://iai_shelves/meshes/Shelf_{}.dae'.format(shelf.id)
                 m.scale = Vector3(1, 1, 1)
                 m.color = ColorRGBA(0, 0, 0, 0)
                 m.mesh_use_embedded_materials = True
-                ma.markers.append(m)
+                markers[i] = m
                 # left
-                m = Marker()
-                m.header.frame_id = MAP
-                m.ns = self.marker_ns
-                m.id = i + 1000
-                m.type = Marker.CUBE
-                m.action = Marker.ADD
-                m.pose.position = Point(*shelf.get_left())
-                m.pose.position.z = 0.03
-                m.pose.orientation = Quaternion(*shelf.get_orientation())
-                m.scale = Vector3(.05, .03, .05)
-                m.color = self.left_color
-                ma.markers.append(m)
+                markers[i + 1000] = self.measurement_marker(shelf.get_left(), shelf.get_orientation(), self.left_color)
                 # right
-                m = deepcopy(m)
-                m.id += 10000
-                m.pose.position = Point(*shelf.get_right())
-                m.pose.position.z = 0.03
-                m.color = self.right_color
-                ma.markers.append(m)
-        self.marker_pub.publish(ma)
+                markers[i + 11000] = self.measurement_marker(shelf.get_right(), shelf.get_orientation(),
+                                                             self.right_color)
+        self.markers.set(self.marker_ns, markers)
+
+    def measurement_marker(self, position, orientation, color):
+        m = Marker()
+        m.header.frame_id = MAP
+        m.type = Marker.CUBE
+        m.pose.position = Point(*position)
+        m.pose.position.z = 0.03
+        m.pose.orientation = Quaternion(*orientation)
+        m.scale = Vector3(.05, .03, .05)
+        m.color = color
+        return m
 
 
 if __name__ == '__main__':
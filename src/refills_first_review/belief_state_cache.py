@@ -0,0 +1,95 @@
+from collections import defaultdict
+from threading import Lock
+from time import time
+
+
+class CachedPredicate(object):
+    def __init__(self, name, ttl=None):
+        """
+        :param ttl: seconds after which a value is reloaded, None if values only expire through invalidation
+        """
+        self.name = name
+        self.ttl = ttl
+        self.values = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def is_fresh(self, stamp):
+        return self.ttl is None or time() - stamp < self.ttl
+
+
+class BeliefStateCache(object):
+    """
+    Read-through cache for pure belief state lookups.
+    Every predicate is invalidated when one of the events it is registered for is fired.
+    """
+    def __init__(self):
+        self.predicates = {}
+        self.subscribers = defaultdict(list)
+        self.lock = Lock()
+
+    def register(self, name, ttl=None, invalidated_by=()):
+        """
+        :param name: name of the cached predicate
+        :param ttl: seconds after which a value is reloaded
+        :param invalidated_by: list of events that invalidate this predicate
+        """
+        self.predicates[name] = CachedPredicate(name, ttl)
+        for event in invalidated_by:
+            self.subscribers[event].append(name)
+
+    def get(self, name, key, load):
+        """
+        :param name: name of the cached predicate
+        :param key: hashable arguments of the lookup
+        :param load: function without arguments that performs the lookup on a miss
+        :return: cached or freshly loaded value
+        """
+        predicate = self.predicates[name]
+        with self.lock:
+            if key in predicate.values:
+                value, stamp = predicate.values[key]
+                if predicate.is_fresh(stamp):
+                    predicate.hits += 1
+                    return value
+            predicate.misses += 1
+            generation = predicate.generation
+        value = load()
+        with self.lock:
+            # don't store values that were loaded while the predicate got invalidated
+            if generation == predicate.generation:
+                predicate.values[key] = (value, time())
+        return value
+
+    def invalidate(self, name, key=None):
+        """
+        :param key: only drop this key, drop all values if None
+        """
+        predicate = self.predicates[name]
+        with self.lock:
+            predicate.generation += 1
+            if key is None:
+                predicate.values.clear()
+            else:
+                predicate.values.pop(key, None)
+
+    def notify(self, event, key=None):
+        """
+        Invalidates every predicate that is registered for event.
+        """
+        for name in self.subscribers[event]:
+            self.invalidate(name, key)
+
+    def clear(self):
+        for name in self.predicates:
+            self.invalidate(name)
+
+    def get_stats(self):
+        """
+        :return: dict predicate name -> dict with hits, misses and number of cached values
+        """
+        with self.lock:
+            return {name: {'hits': p.hits,
+                           'misses': p.misses,
+                           'size': len(p.values)} for name, p in self.predicates.items()}
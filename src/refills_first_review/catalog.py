@@ -0,0 +1,145 @@
+import json
+import os
+import struct
+import tempfile
+from threading import Lock
+
+import numpy as np
+import rospy
+from rospkg import RosPack
+
+MAGIC = 'RCAT'
+VERSION = 1
+# magic, version, number of products, bytes per barcode
+HEADER = struct.Struct('<4sIII')
+ENTRY = np.dtype([('mesh_offset', '<u4'), ('mesh_length', '<u4'), ('type_offset', '<u4'), ('type_length', '<u4')])
+
+_catalog = None
+_catalog_lock = Lock()
+
+
+def product_type_from_mesh(mesh_path):
+    """
+    :return: product name of a mesh path like 'low_resolution/Shelf1/<product>/SM_<product>.dae', '' if unknown
+    """
+    parts = mesh_path.split('/')
+    if len(parts) < 2:
+        return ''
+    return parts[-2]
+
+
+def build_index(json_path, index_path):
+    """
+    Writes the products of a barcode -> mesh path json file as sorted binary index.
+    Layout: header, sorted fixed size barcodes, one ENTRY per barcode, utf-8 string data.
+    """
+    with open(json_path) as f:
+        barcode_to_mesh = json.load(f)
+    barcodes = sorted(str(barcode) for barcode in barcode_to_mesh)
+    key_size = max([len(barcode) for barcode in barcodes] + [1])
+    entries = np.zeros(len(barcodes), dtype=ENTRY)
+    strings = []
+    offset = 0
+    for i, barcode in enumerate(barcodes):
+        mesh_path = barcode_to_mesh[barcode].encode('utf-8')
+        product_type = product_type_from_mesh(barcode_to_mesh[barcode]).encode('utf-8')
+        entries[i] = (offset, len(mesh_path), offset + len(mesh_path), len(product_type))
+        strings.append(mesh_path)
+        strings.append(product_type)
+        offset += len(mesh_path) + len(product_type)
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(barcodes), key_size))
+        f.write(np.array(barcodes, dtype='S{}'.format(key_size)).tobytes())
+        f.write(entries.tobytes())
+        f.write(''.join(strings))
+    os.rename(tmp_path, index_path)
+    rospy.loginfo('built product catalog index {} with {} products'.format(index_path, len(barcodes)))
+
+
+class Catalog(object):
+    """
+    Read only, memory mapped product catalog with O(log n) lookups by barcode.
+    Can be used like the dict barcode -> mesh path from barcode_to_mesh.json.
+    """
+    def __init__(self, index_path):
+        data = np.memmap(index_path, dtype=np.uint8, mode='r')
+        magic, version, size, key_size = HEADER.unpack(data[:HEADER.size].tobytes())
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a product catalog index of version {}'.format(index_path, VERSION))
+        offset = HEADER.size
+        self.barcodes = data[offset:offset + size * key_size].view('S{}'.format(key_size))
+        offset += size * key_size
+        self.entries = data[offset:offset + size * ENTRY.itemsize].view(ENTRY)
+        offset += size * ENTRY.itemsize
+        self.strings = data[offset:]
+        self.key_size = key_size
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def find(self, barcode):
+        """
+        :return: index of barcode, None if it is not in the catalog
+        """
+        barcode = str(barcode)
+        if len(barcode) > self.key_size:
+            return None
+        i = np.searchsorted(self.barcodes, barcode)
+        if i < len(self.barcodes) and self.barcodes[i] == barcode:
+            return i
+        return None
+
+    def __contains__(self, barcode):
+        return self.find(barcode) is not None
+
+    def string(self, offset, length):
+        return self.strings[offset:offset + length].tobytes().decode('utf-8')
+
+    def get_mesh_path(self, barcode, default=None):
+        i = self.find(barcode)
+        if i is None:
+            return default
+        entry = self.entries[i]
+        return self.string(entry['mesh_offset'], entry['mesh_length'])
+
+    def get_product_type(self, barcode, default=None):
+        i = self.find(barcode)
+        if i is None:
+            return default
+        entry = self.entries[i]
+        return self.string(entry['type_offset'], entry['type_length'])
+
+    def __getitem__(self, barcode):
+        mesh_path = self.get_mesh_path(barcode)
+        if mesh_path is None:
+            raise KeyError(barcode)
+        return mesh_path
+
+    def get(self, barcode, default=None):
+        return self.get_mesh_path(barcode, default)
+
+    def keys(self):
+        return [barcode for barcode in self.barcodes.tolist()]
+
+
+def get_catalog(json_path=None):
+    """
+    Opens the product catalog that is shared by all users in this process.
+    The index is (re)built from json_path if it does not exist or is older than the json file.
+    :param json_path: defaults to data/barcode_to_mesh.json of this package
+    :rtype: Catalog
+    """
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            if json_path is None:
+                json_path = RosPack().get_path('refills_first_review') + '/data/barcode_to_mesh.json'
+            index_path = json_path + '.idx'
+            if not os.access(os.path.dirname(index_path), os.W_OK):
+                index_path = os.path.join(tempfile.gettempdir(), 'refills_catalog_{}.idx'.format(
+                    abs(hash(os.path.abspath(json_path)))))
+            if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(json_path):
+                build_index(json_path, index_path)
+            _catalog = Catalog(index_path)
+        return _catalog
@@ -0,0 +1,143 @@
+from collections import deque
+from threading import Lock, RLock
+
+import rospy
+
+from refills_first_review.poses import PoseBatch
+
+
+class DeferredTransformer(object):
+    """
+    Transforms poses from subscriber callbacks without blocking them.
+    Poses whose transform is not available yet are parked and processed as soon as tf caught up,
+    or dropped once they are older than the deadline.
+    The callback is never called with the lock of the parked poses held, such that it may call add,
+    but calls of it are serialized.
+    """
+    def __init__(self, tf, name, callback, deadline=1.0, period=0.05, via=None):
+        """
+        :type tf: refills_first_review.tfwrapper.TfWrapper
+        :param name: used in log messages
+        :param callback: function(batch, payload) that gets the poses that were added together as PoseBatch
+                         in the target frame, rows that could not be transformed are nan
+        :param deadline: seconds a pose may wait for its transform
+        :param period: seconds between two retries of the parked poses
+        :param via: see TfWrapper.transform_poses
+        """
+        self.tf = tf
+        self.name = name
+        self.callback = callback
+        self.deadline = rospy.Duration(deadline)
+        self.via = via
+        self.pending = deque()
+        self.lock = Lock()
+        # reentrant, such that the callback may call add
+        self.callback_lock = RLock()
+        # batches that were taken for the callback, but it has not returned yet
+        self.in_flight = 0
+        self.reset_stats()
+        self.timer = rospy.Timer(rospy.Duration(period), self.retry_cb)
+
+    def reset_stats(self):
+        with self.lock:
+            self.processed = 0
+            self.late = 0
+            self.dropped = 0
+
+    def get_stats(self):
+        """
+        :return: dict with the number of processed messages, how many of them had to wait for tf,
+                 how many were dropped and how many are still waiting
+        """
+        with self.lock:
+            return {'processed': self.processed,
+                    'late': self.late,
+                    'dropped': self.dropped,
+                    'pending': len(self.pending)}
+
+    def log_stats(self):
+        rospy.loginfo('{}: {processed} messages transformed, {late} of them late, {dropped} dropped, '
+                      '{pending} pending'.format(self.name, **self.get_stats()))
+
+    def add(self, target_frame, poses, payload=None):
+        """
+        Never blocks. callback is called right away if all transforms are available.
+        :type poses: list of PoseStamped
+        """
+        with self.lock:
+            batch = self.try_transform(target_frame, poses)
+            if batch is None:
+                self.pending.append((target_frame, poses, payload, rospy.get_rostime()))
+                return
+            self.processed += 1
+            self.in_flight += 1
+        self.call_callback([(batch, payload)])
+
+    def can_transform(self, target_frame, poses):
+        for p in poses:
+            if self.via is None:
+                if not self.tf.tfBuffer.can_transform(target_frame, p.header.frame_id, p.header.stamp):
+                    return False
+            elif not (self.tf.tfBuffer.can_transform(self.via, p.header.frame_id, p.header.stamp) and
+                      self.tf.tfBuffer.can_transform(target_frame, self.via, rospy.Time())):
+                return False
+        return True
+
+    def try_transform(self, target_frame, poses):
+        """
+        :return: PoseBatch in target_frame, None if the transforms are not available yet
+        """
+        if not self.can_transform(target_frame, poses):
+            return None
+        positions, orientations = self.tf.transform_poses(target_frame, poses, via=self.via, timeout=0.)
+        return PoseBatch(target_frame, positions, orientations)
+
+    def call_callback(self, ready):
+        """
+        :param ready: list of (PoseBatch, payload), that were counted in in_flight
+        """
+        try:
+            with self.callback_lock:
+                for batch, payload in ready:
+                    self.callback(batch, payload)
+        finally:
+            with self.lock:
+                self.in_flight -= len(ready)
+
+    def retry(self):
+        """
+        Processes parked poses whose transforms became available and drops expired ones.
+        """
+        ready = []
+        with self.lock:
+            now = rospy.get_rostime()
+            still_pending = deque()
+            for target_frame, poses, payload, arrival in self.pending:
+                batch = self.try_transform(target_frame, poses)
+                if batch is not None:
+                    ready.append((batch, payload))
+                elif now - arrival > self.deadline:
+                    self.dropped += 1
+                else:
+                    still_pending.append((target_frame, poses, payload, arrival))
+            self.pending = still_pending
+            self.processed += len(ready)
+            self.late += len(ready)
+            self.in_flight += len(ready)
+        if ready:
+            self.call_callback(ready)
+
+    def retry_cb(self, event):
+        if self.pending:
+            self.retry()
+
+    def flush(self):
+        """
+        Blocks until every parked pose was processed or dropped and the callback returned for all of them.
+        """
+        while True:
+            self.retry()
+            with self.lock:
+                if not self.pending and self.in_flight == 0:
+                    return
+            rospy.sleep(0.01)
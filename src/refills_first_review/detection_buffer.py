@@ -0,0 +1,79 @@
+import numpy as np
+
+
+class DetectionBuffer(object):
+    """
+    Preallocated, growable buffer of weighted 3D detections.
+    With a voxel size, detections that fall into the same grid cell are merged into one row
+    with their count as weight and their mean as position, which bounds memory by the scanned volume
+    instead of the duration of the scan.
+    """
+    def __init__(self, voxel_size=0., capacity=1024):
+        """
+        :param voxel_size: edge length of the grid cells in m, 0 to keep every detection
+        :param capacity: initial number of rows
+        """
+        self.voxel_size = voxel_size
+        self.positions = np.empty((capacity, 3))
+        self.weights = np.empty(capacity)
+        self.clear()
+
+    def clear(self):
+        self.size = 0
+        self.num_detections = 0
+        self.cells = {}
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, n):
+        """
+        Makes room for n more rows, by doubling the capacity if needed.
+        """
+        capacity = len(self.weights)
+        if self.size + n <= capacity:
+            return
+        while self.size + n > capacity:
+            capacity *= 2
+        positions = np.empty((capacity, 3))
+        positions[:self.size] = self.positions[:self.size]
+        weights = np.empty(capacity)
+        weights[:self.size] = self.weights[:self.size]
+        self.positions = positions
+        self.weights = weights
+
+    def add(self, positions, weight=1):
+        """
+        :param positions: Nx3 array
+        :param weight: number of detections at each position
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        self.num_detections += len(positions)
+        self.reserve(len(positions))
+        if self.voxel_size <= 0:
+            self.positions[self.size:self.size + len(positions)] = positions
+            self.weights[self.size:self.size + len(positions)] = weight
+            self.size += len(positions)
+            return
+        keys = np.floor(positions / self.voxel_size).astype(np.int64)
+        for key, position in zip(map(tuple, keys), positions):
+            i = self.cells.get(key)
+            if i is None:
+                i = self.size
+                self.cells[key] = i
+                self.positions[i] = position
+                self.weights[i] = weight
+                self.size += 1
+            else:
+                total = self.weights[i] + weight
+                self.positions[i] += (position - self.positions[i]) * (weight / total)
+                self.weights[i] = total
+
+    def get_positions(self):
+        """
+        :return: view of the Nx3 positions
+        """
+        return self.positions[:self.size]
+
+    def get_weights(self):
+        return self.weights[:self.size]
@@ -0,0 +1,106 @@
+import traceback
+from Queue import Queue
+from multiprocessing import TimeoutError
+from threading import Event, Lock, Thread
+from time import time
+
+import rospy
+
+
+class Future(object):
+    """
+    Result of an operation that finishes in another thread.
+    """
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            if self.done():
+                return
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        :param callback: function(future), called right away if the future is already done
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError()
+        return self._exception
+
+    def result(self, timeout=None):
+        """
+        :param timeout: max seconds to wait, None to wait forever
+        :return: the result, raises the exception of the operation if it failed or TimeoutError
+        """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+def wait_all(futures, timeout=None):
+    """
+    Waits for many futures with one common deadline.
+    :return: list of futures that are not done yet
+    """
+    deadline = None if timeout is None else time() + timeout
+    for future in futures:
+        remaining = None if deadline is None else max(deadline - time(), 0)
+        future._event.wait(remaining)
+    return [future for future in futures if not future.done()]
+
+
+class Worker(object):
+    """
+    Runs functions one after another in a background thread.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.jobs = Queue()
+        self.thread = Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        :return: Future of the result of function(*args, **kwargs)
+        """
+        future = Future()
+        self.jobs.put((future, function, args, kwargs))
+        return future
+
+    def run(self):
+        while True:
+            future, function, args, kwargs = self.jobs.get()
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                rospy.logerr('{} failed:\n{}'.format(self.name, traceback.format_exc()))
+                future.set_exception(e)
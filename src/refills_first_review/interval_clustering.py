@@ -0,0 +1,105 @@
+from bisect import bisect_right
+
+import numpy as np
+
+
+class Interval(object):
+    def __init__(self, x, position, weight, keep_points):
+        self.lo = x
+        self.hi = x
+        self.weight = weight
+        self.position_sum = position * weight
+        self.points = [(x, weight, position)] if keep_points else None
+
+    def merge(self, other):
+        self.lo = min(self.lo, other.lo)
+        self.hi = max(self.hi, other.hi)
+        self.weight += other.weight
+        self.position_sum = self.position_sum + other.position_sum
+        if self.points is not None:
+            self.points.extend(other.points)
+
+
+class IntervalClustering(object):
+    """
+    Incremental DBSCAN along the x axis.
+    Points are merged into sorted, disjoint intervals of points whose neighbours are at most max_dist apart,
+    such that the clusters are available at any time without looking at all points again.
+    With min_samples=1 every interval is exactly one DBSCAN cluster of the x coordinates.
+    With min_samples>1 all points are kept, memory grows with the number of added points like with DBSCAN.
+    """
+    def __init__(self, max_dist, min_samples=1):
+        self.max_dist = max_dist
+        self.min_samples = min_samples
+        self.keep_points = min_samples > 1
+        self.los = []
+        self.intervals = []
+        self.num_points = 0
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, position, weight=1):
+        """
+        :param position: [x, y, z]
+        :param weight: number of detections at position
+        """
+        position = np.asarray(position, dtype=float)
+        x = position[0]
+        new = Interval(x, position, weight, self.keep_points)
+        end = bisect_right(self.los, x + self.max_dist)
+        start = end
+        while start > 0 and self.intervals[start - 1].hi >= x - self.max_dist:
+            start -= 1
+        for interval in self.intervals[start:end]:
+            new.merge(interval)
+        self.los[start:end] = [new.lo]
+        self.intervals[start:end] = [new]
+        self.num_points += 1
+
+    def add_batch(self, positions, weight=1):
+        """
+        :param positions: Nx3 array
+        """
+        for position in positions:
+            self.add(position, weight)
+
+    def get_clusters(self):
+        """
+        :return: list of (weighted mean position, weight) of all clusters, sorted by x
+        """
+        if not self.keep_points:
+            return [(interval.position_sum / interval.weight, interval.weight) for interval in self.intervals]
+        clusters = []
+        for interval in self.intervals:
+            clusters.extend(self.split(interval))
+        return clusters
+
+    def split(self, interval):
+        """
+        Runs DBSCAN with min_samples on the points of one interval. Border points are assigned to the cluster
+        of their closest core point, sklearn assigns a border point of two clusters to the one it visits first.
+        """
+        points = sorted(interval.points, key=lambda p: p[0])
+        xs = np.array([x for x, _, _ in points])
+        weights = np.array([weight for _, weight, _ in points], dtype=float)
+        positions = np.array([position for _, _, position in points])
+        cumulative = np.concatenate([[0.], np.cumsum(weights)])
+        neighbours = (cumulative[np.searchsorted(xs, xs + self.max_dist, side='right')] -
+                      cumulative[np.searchsorted(xs, xs - self.max_dist, side='left')])
+        core = np.flatnonzero(neighbours >= self.min_samples)
+        if len(core) == 0:
+            return []
+        core_labels = np.concatenate([[0], np.cumsum(np.diff(xs[core]) > self.max_dist)])
+        # closest core point of every point
+        right = np.clip(np.searchsorted(xs[core], xs), 0, len(core) - 1)
+        left = np.clip(right - 1, 0, len(core) - 1)
+        closest = np.where(np.abs(xs[core][left] - xs) < np.abs(xs[core][right] - xs), left, right)
+        members = np.abs(xs[core][closest] - xs) <= self.max_dist
+        labels = np.where(members, core_labels[closest], -1)
+        clusters = []
+        for label in range(core_labels[-1] + 1):
+            mask = labels == label
+            weight = weights[mask].sum()
+            clusters.append((np.average(positions[mask], axis=0, weights=weights[mask]), weight))
+        return clusters
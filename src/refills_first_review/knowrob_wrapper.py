@@ -1,12 +1,21 @@
 import json
+import logging
 from collections import OrderedDict, defaultdict
-from multiprocessing import Lock
+from itertools import islice
+from time import time
 from rospkg import RosPack
 
 import rospy
-from geometry_msgs.msg import PoseStamped, Point, Quaternion
+from geometry_msgs.msg import PoseStamped
+from std_srvs.srv import Trigger, TriggerResponse
 import numpy as np
-from json_prolog import json_prolog
+from refills_first_review.action_graph_logger import ActionGraphLogger
+from refills_first_review.belief_state_cache import BeliefStateCache
+from refills_first_review.catalog import get_catalog
+from refills_first_review.poses import Pose, PoseBatch
+from refills_first_review.prolog_pool import PrologPool
+from refills_first_review.prolog_replay import PrologRecorder, PrologReplay
+from refills_first_review.prolog_stats import PrologStats
 from refills_first_review.tfwrapper import TfWrapper
 
 MAP = 'map'
@@ -27,6 +36,20 @@ OBJECT_ACTED_ON = '\'http://knowrob.org/kb/knowrob.owl#objectActedOn\''
 GOAL_LOCATION = '\'http://knowrob.org/kb/knowrob.owl#goalLocation\''
 DETECTED_OBJECT = '\'http://knowrob.org/kb/knowrob.owl#detectedObject\''
 
+# events that invalidate cached belief state lookups
+FLOORS_CHANGED = 'floors'
+SHELF_PARTS_CHANGED = 'shelf_parts'
+POSES_CHANGED = 'poses'
+OBJECTS_CHANGED = 'objects'
+
+# max number of goals that are combined into one query by prolog_batch_query
+PROLOG_BATCH_SIZE = 50
+
+# min time in s between two debug messages of the same kind about prolog queries
+PROLOG_TRACE_PERIOD = 1.0
+# max length of a traced query or solution
+PROLOG_TRACE_LENGTH = 500
+
 
 class ActionGraph(object):
     Action = 0
@@ -51,62 +74,69 @@ class ActionGraph(object):
     def start_experiment(cls, knowrob, action_type):
         q = 'cram_start_situation(\'{}\', \'{}\', R), rdf_assert(R,knowrob:performedBy,donbot:iai_donbot_robot1, \'LoggingGraph\'), rdf_assert(R,knowrob:performedInMap,iaishop:\'IAIShop_0\', \'LoggingGraph\')'.format(action_type, ActionGraph.unix_time_seconds())
         # if cls.logging:
-        id = knowrob.prolog_query(q)[0]['R']
+        id = knowrob.prolog_first(q, ordered=True)['R']
         return cls(knowrob, id=id)
 
-    def finish(self):
-        q = 'cram_finish_action({}, {})'.format(self.id, ActionGraph.unix_time_seconds())
+    def finish(self, t=None):
+        """
+        :param t: unix time at which the action ended, default now
+        """
+        if t is None:
+            t = ActionGraph.unix_time_seconds()
         if self.logging:
-            self.knowrob.prolog_query(q)
+            self.knowrob.action_logger.log(lambda ref, var: 'cram_finish_action({}, {})'.format(ref(self), t))
         return self.parent_node
 
-    def create_thingy(self, action_class, action_type):
-        if self.last_sub_action is not None and self.last_sub_action.type == action_type:
-            previous_thing = self.last_sub_action.id
+    def create_thingy(self, ref, var, action_class, action_type, t, previous_node):
+        if previous_node is not None and previous_node.type == action_type:
+            previous_thing = ref(previous_node)
         else:
             previous_thing = '_'
-        q = '{}(\'{}\', \'{}\', {}, R)'.format(self.type_to_cram_start(action_type), action_class,
-                                                   str(ActionGraph.unix_time_seconds()),
-                                                   previous_thing)
-        if self.logging:
-            result = self.knowrob.prolog_query(q)[0]['R']
-            return result
-        else:
-            return ''
-
-    def add_sub_thingy(self, action_type, sub_type, object_acted_on=None, goal_location=None, detected_objects=None):
-        new_id = self.create_thingy(action_type, sub_type)
-
-        q = 'rdf_assert({}, {}, {}, \'LoggingGraph\')'.format(self.id, self.type_to_sub(sub_type), new_id)
-        if self.logging:
-            self.knowrob.prolog_query(q)
+        return '{}(\'{}\', \'{}\', {}, {})'.format(self.type_to_cram_start(action_type), action_class, t,
+                                                previous_thing, var)
 
+    def add_sub_thingy(self, action_type, sub_type, object_acted_on=None, goal_location=None, detected_objects=None,
+                       t=None):
+        """
+        :param t: unix time at which the sub action started, default now
+        """
+        t = str(ActionGraph.unix_time_seconds() if t is None else t)
+        previous_sub_action = self.last_sub_action
+        new_node = ActionGraph(knowrob=self.knowrob, parent_node=self, previous_node=previous_sub_action,
+                               id=None if self.logging else '', type=sub_type)
+
+        def query(ref, var):
+            goals = [self.create_thingy(ref, var, action_type, sub_type, t, previous_sub_action),
+                     'rdf_assert({}, {}, {}, \'LoggingGraph\')'.format(ref(self), self.type_to_sub(sub_type), var)]
             if object_acted_on is not None:
-                q = 'rdf_assert({}, {}, \'{}\', \'LoggingGraph\')'.format(new_id, OBJECT_ACTED_ON, object_acted_on)
-                self.knowrob.prolog_query(q)
+                goals.append('rdf_assert({}, {}, \'{}\', \'LoggingGraph\')'.format(var, OBJECT_ACTED_ON,
+                                                                                   object_acted_on))
             if goal_location is not None:
                 if '[' in goal_location:
                     translation = eval(goal_location.split(', ')[-2])
                     rotation = eval(goal_location.split(', ')[-1][:-1])
-                    q = 'belief_new_pose(({}, {}), Id),' \
-                        'rdf_assert({}, {}, Id, \'LoggingGraph\')'.format(translation, rotation, new_id, GOAL_LOCATION)
+                    goals.append('belief_new_pose(({}, {}), {}Pose),'
+                                 'rdf_assert({}, {}, {}Pose, \'LoggingGraph\')'.format(translation, rotation, var,
+                                                                                     var, GOAL_LOCATION, var))
                 else:
-                    q = 'rdf_assert({}, {}, \'{}\', \'LoggingGraph\')'.format(new_id, GOAL_LOCATION, goal_location)
-                self.knowrob.prolog_query(q)
+                    goals.append('rdf_assert({}, {}, \'{}\', \'LoggingGraph\')'.format(var, GOAL_LOCATION,
+                                                                                       goal_location))
             if detected_objects is not None:
                 for detected_object in detected_objects:
-                    q = 'rdf_assert({}, {}, \'{}\', \'LoggingGraph\')'.format(new_id, DETECTED_OBJECT, detected_object)
-                    self.knowrob.prolog_query(q)
+                    goals.append('rdf_assert({}, {}, \'{}\', \'LoggingGraph\')'.format(var, DETECTED_OBJECT,
+                                                                                       detected_object))
+            return ', '.join(goals)
 
-        self.last_sub_action = ActionGraph(knowrob=self.knowrob, parent_node=self, previous_node=self.last_sub_action,
-                                           id=new_id, type=sub_type)
+        if self.logging:
+            self.knowrob.action_logger.log(query, new_node)
+        self.last_sub_action = new_node
         return self.last_sub_action
 
     def add_sub_action(self, action_type, object_acted_on=None, goal_location=None, detected_objects=None):
         return self.add_sub_thingy(action_type, self.Action, object_acted_on, goal_location, detected_objects)
 
-    def add_sub_event(self, event_type, object_acted_on=None, goal_location=None, detected_objects=None):
-        return self.add_sub_thingy(event_type, self.Event, object_acted_on, goal_location, detected_objects)
+    def add_sub_event(self, event_type, object_acted_on=None, goal_location=None, detected_objects=None, t=None):
+        return self.add_sub_thingy(event_type, self.Event, object_acted_on, goal_location, detected_objects, t)
 
     def add_sub_motion(self, motion_type, object_acted_on=None, goal_location=None, detected_objects=None):
         return self.add_sub_thingy(motion_type, self.Motion, object_acted_on, goal_location, detected_objects)
@@ -128,116 +158,291 @@ class ActionGraph(object):
             return 'cram_start_event'
 
     def __str__(self):
-        return self.id.split('3')[-1]
+        return str(self.id).split('3')[-1]
+
+
+class Facings(object):
+    """
+    The facings of a shelf layer, stored as columns.
+    """
+    def __init__(self, ids, positions, widths, products, left_separators):
+        self.ids = list(ids)
+        self.positions = np.array(positions, dtype=float).reshape(-1, 3)
+        self.widths = np.array(widths, dtype=float)
+        self.products = list(products)
+        self.left_separators = list(left_separators)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        """
+        :return: iterator over (facing id, position, product, width, left separator id)
+        """
+        return iter(zip(self.ids, self.positions, self.products, self.widths, self.left_separators))
+
+    def sorted_by_x(self, reverse=False):
+        order = np.argsort(self.positions[:, 0], kind='mergesort')
+        if reverse:
+            order = order[::-1]
+        return Facings(ids=[self.ids[i] for i in order],
+                       positions=self.positions[order],
+                       widths=self.widths[order],
+                       products=[self.products[i] for i in order],
+                       left_separators=[self.left_separators[i] for i in order])
 
 
 class KnowRob(object):
-    def __init__(self):
+    def __init__(self, async_action_logging=False, prolog_pool_size=4, record_path=None, replay_path=None,
+                 replay_latency=0., replay_time_scale=0., static_shelf_frames=False):
+        """
+        :param record_path: if not None, all prolog queries and their solutions are appended to this file
+        :param replay_path: if not None, prolog queries are answered from this recording instead of json_prolog
+        :param replay_latency: seconds every replayed query is delayed
+        :param replay_time_scale: additionally delay replayed queries by this factor times the recorded time
+        :param static_shelf_frames: if True, the frames of shelves and floors are sent on /tf_static when they are
+                                    added or moved. Only use it if they are not published on /tf by KnowRob.
+        """
         # TODO implement all the things [high]
         # TODO use paramserver [low]
         self.floors = {}
         self.shelf_ids = []
         self.separators = {}
-        self.perceived_frame_id_map = {}
         self.action_graph = None
         self.tf = TfWrapper()
-        self.prolog = json_prolog.Prolog()
-        self.prolog.wait_for_service()
-        self.query_lock = Lock()
-
-    def prolog_query(self, q):
-        # print('before lock')
-        with self.query_lock:
-            print('sending {}'.format(q))
-            query = self.prolog.query(q)
-            solutions = [x if x != {} else True for x in query.solutions()]
-            # if len(solutions) > 1:
-            #     rospy.logwarn('{} returned more than one result'.format(q))
-            # elif len(solutions) == 0:
-            #     rospy.logwarn('{} returned nothing'.format(q))
-            query.finish()
-            print('solutions {}'.format(solutions))
-            print('----------------------')
-            return solutions
+        self.static_shelf_frames = static_shelf_frames
+        if replay_path is None:
+            self.prolog = PrologPool(prolog_pool_size)
+        else:
+            self.prolog = PrologPool(prolog_pool_size, PrologReplay(replay_path, replay_latency,
+                                                                         replay_time_scale).client)
+        self.prolog_recorder = None if record_path is None else PrologRecorder(record_path)
+        self.prolog_stats = PrologStats()
+        self.prolog_stats_srv = rospy.Service('~prolog_stats', Trigger, self.prolog_stats_cb)
+        self.last_trace = {}
+        self.action_logger = ActionGraphLogger(self, asynchronous=async_action_logging)
+        self.cache = BeliefStateCache()
+        self.cache.register('perceived_frame_id')
+        self.cache.register('object_frame_id')
+        self.cache.register('hanging_floor', invalidated_by=[FLOORS_CHANGED])
+        self.cache.register('separators', invalidated_by=[SHELF_PARTS_CHANGED])
+        self.cache.register('mounting_bars', invalidated_by=[SHELF_PARTS_CHANGED])
+        self.cache.register('barcodes', invalidated_by=[SHELF_PARTS_CHANGED])
+        self.cache.register('objects', invalidated_by=[OBJECTS_CHANGED, POSES_CHANGED])
+
+    def prolog_query(self, q, ordered=False):
+        """
+        :param ordered: set to True for queries that change the belief state, they are executed in the order
+                        they were sent. Other queries may run in parallel.
+        :return: list of all solutions
+        """
+        solutions = list(self.prolog_iter(q, ordered=ordered))
+        # if len(solutions) > 1:
+        #     rospy.logwarn('{} returned more than one result'.format(q))
+        # elif len(solutions) == 0:
+        #     rospy.logwarn('{} returned nothing'.format(q))
+        self.trace('solutions', 'solutions {}', solutions)
+        return solutions
+
+    def prolog_iter(self, q, limit=None, ordered=False):
+        """
+        Yields the solutions of q as they arrive. The query is finished as soon as the iteration stops,
+        because all solutions or limit solutions were consumed or because the generator got closed.
+        :param limit: max number of solutions that are requested, None for all
+        """
+        start = time()
+        client, wait_time = self.prolog.acquire(ordered)
+        query = None
+        solutions = []
+        try:
+            self.trace('sending', 'sending {}', q)
+            query = client.query(q)
+            for solution in islice(query.solutions(), limit):
+                solutions.append(solution)
+                yield solution if solution != {} else True
+        finally:
+            if query is not None:
+                query.finish()
+            end = time()
+            self.prolog.release(client, ordered, wait_time, end - start - wait_time)
+            self.prolog_stats.add(q, end - start, wait_time, len(solutions))
+            if self.prolog_recorder is not None:
+                self.prolog_recorder.record(q, solutions, end - start - wait_time)
+
+    def prolog_first(self, q, ordered=False):
+        """
+        :return: the first solution of q or None, remaining solutions are not computed
+        """
+        solutions = self.prolog_iter(q, limit=1, ordered=ordered)
+        try:
+            return next(solutions, None)
+        finally:
+            solutions.close()
+
+    def trace(self, kind, msg, *args):
+        """
+        Rate limited debug output about prolog queries, args are only formatted if the message gets published.
+        :param kind: messages of the same kind are published at most once per PROLOG_TRACE_PERIOD
+        """
+        if not logging.getLogger('rosout').isEnabledFor(logging.DEBUG):
+            return
+        now = time()
+        if now - self.last_trace.get(kind, 0) < PROLOG_TRACE_PERIOD:
+            return
+        self.last_trace[kind] = now
+        rospy.logdebug(msg.format(*[str(arg)[:PROLOG_TRACE_LENGTH] for arg in args]))
+
+    def get_prolog_stats(self):
+        """
+        :return: list of (predicate head, stats), see PrologStats.get_report
+        """
+        return self.prolog_stats.get_report()
+
+    def save_prolog_stats(self, path):
+        self.prolog_stats.save(path)
+
+    def prolog_stats_cb(self, req):
+        """
+        Returns the prolog stats and the stats of the belief state cache as json.
+        """
+        return TriggerResponse(success=True, message=json.dumps({'queries': self.get_prolog_stats(),
+                                                                 'cache': self.cache.get_stats()}))
+
+    def prolog_batch_query(self, goals, batch_size=PROLOG_BATCH_SIZE):
+        """
+        Asserts a list of independent goals with one conjunctive query per batch_size goals.
+        Every goal is wrapped, such that a failing goal does not abort the rest of the batch.
+        Named variables are shared within a batch, use _ or unique names.
+        :param goals: list of prolog goals
+        :return: list of bools, one per goal, True if the goal succeeded
+        """
+        results = []
+        for start in range(0, len(goals), batch_size):
+            batch = goals[start:start + batch_size]
+            _, successes = self.prolog_batch(batch)
+            for goal, success in zip(batch, successes):
+                if not success:
+                    rospy.logwarn('failed to assert {}'.format(goal))
+            results.extend(successes)
+        return results
+
+    def prolog_batch(self, goals):
+        """
+        Sends goals as one conjunctive query, every goal is wrapped, such that a failing goal does not abort the others.
+        :param goals: list of prolog goals
+        :return: (solution, list of bools, one per goal, True if the goal succeeded), solution is None if the query
+                 failed as a whole
+        """
+        q = ', '.join('(catch(({}), _, fail) -> S{} = 1 ; S{} = 0)'.format(goal, i, i) for i, goal in enumerate(goals))
+        solution = self.prolog_first(q, ordered=True)
+        return solution, [solution is not None and solution['S{}'.format(i)] == 1 for i in range(len(goals))]
 
     def remove_http_shit(self, s):
         return s.split('#')[-1].split('\'')[0]
 
     def load_barcode_to_mesh_map(self):
-        self.barcode_to_mesh = json.load(open('../../data/barcode_to_mesh.json'))
+        self.barcode_to_mesh = get_catalog()
 
     def pose_to_prolog(self, pose_stamped):
-        return '[\'{}\', _, [{},{},{}], [{},{},{},{}]]'.format(pose_stamped.header.frame_id,
-                                                               pose_stamped.pose.position.x,
-                                                               pose_stamped.pose.position.y,
-                                                               pose_stamped.pose.position.z,
-                                                               pose_stamped.pose.orientation.x,
-                                                               pose_stamped.pose.orientation.y,
-                                                               pose_stamped.pose.orientation.z,
-                                                               pose_stamped.pose.orientation.w)
+        """
+        :type pose_stamped: PoseStamped or Pose
+        """
+        if isinstance(pose_stamped, PoseStamped):
+            pose_stamped = Pose.from_msg(pose_stamped)
+        return pose_stamped.to_prolog()
 
     def prolog_to_pose_msg(self, query_result):
-        ros_pose = PoseStamped()
-        ros_pose.header.frame_id = query_result[0]
-        ros_pose.pose.position = Point(*query_result[2])
-        ros_pose.pose.orientation = Quaternion(*query_result[3])
-        return ros_pose
+        return Pose.from_prolog(query_result).to_msg()
 
     def add_shelf_system(self):
         q = 'belief_new_object({}, R), rdf_assert(R, knowrob:describedInMap, iaishop:\'IAIShop_0\', belief_state)'.format(
             SHELF_SYSTEM)
-        shelf_system_id = self.prolog_query(q)[0]['R'].replace('\'', '')
+        shelf_system_id = self.prolog_first(q, ordered=True)['R'].replace('\'', '')
         return shelf_system_id
 
     # shelves
     def add_shelves(self, shelf_system_id, shelves):
-        # TODO failure handling
-        for name, pose in shelves.items():
-            q = 'belief_new_object({}, ID), ' \
-                'rdf_assert(\'{}\', knowrob:properPhysicalParts, ID, belief_state),' \
-                'object_affordance_static_transform(ID, A, [_,_,T,R]),' \
-                'rdfs_individual_of(A, {})'.format(SHELF_METER, shelf_system_id, PERCEPTION_AFFORDANCE)
-            solutions = self.prolog_query(q)[0]
-            pose.pose.position.x -= solutions['T'][0]
-            pose.pose.position.y -= solutions['T'][1]
-            pose.pose.position.z -= solutions['T'][2]
-            object_id = solutions['ID'].replace('\'', '')
-            q = 'belief_at_update(\'{}\', {})'.format(object_id, self.pose_to_prolog(pose))
-            solutions = self.prolog_query(q)
-
-        return True
+        """
+        Creates one shelf per pose with one batched query and sets their poses with another one.
+        :type shelves: OrderedDict name -> Pose
+        :return: True if all shelves were added
+        """
+        if len(shelves) == 0:
+            return True
+        goals = []
+        for i in range(len(shelves)):
+            goals.append('belief_new_object({}, ID{}), '
+                         'rdf_assert(\'{}\', knowrob:properPhysicalParts, ID{}, belief_state), '
+                         'once((object_affordance_static_transform(ID{}, A{}, [_,_,T{},_]), '
+                         'rdfs_individual_of(A{}, {})))'.format(SHELF_METER, i, shelf_system_id, i, i, i, i, i,
+                                                                PERCEPTION_AFFORDANCE))
+        solution, successes = self.prolog_batch(goals)
+        if any(successes):
+            self.cache.notify(OBJECTS_CHANGED)
+        goals = []
+        shelf_ids = []
+        for i, (name, pose) in enumerate(shelves.items()):
+            if not successes[i]:
+                rospy.logwarn('failed to add shelf {} to {}'.format(name, shelf_system_id))
+                continue
+            offset = np.array(solution['T{}'.format(i)], dtype=float)
+            pose = Pose(pose.frame_id, pose.position - offset, pose.orientation)
+            object_id = solution['ID{}'.format(i)].replace('\'', '')
+            goals.append('belief_at_update(\'{}\', {})'.format(object_id, pose.to_prolog()))
+            shelf_ids.append(object_id)
+        results = self.prolog_batch_query(goals)
+        if len(goals) > 0:
+            self.cache.notify(POSES_CHANGED)
+        self.publish_static_frames([object_id for object_id, success in zip(shelf_ids, results) if success])
+        return all(successes) and all(results)
 
     def get_objects(self, type):
-        # TODO failure handling
-        objects = OrderedDict()
-        q = 'rdfs_individual_of(R, {}).'.format(type)
-        solutions = self.prolog_query(q)
-        for solution in solutions:
-            object_id = solution['R'].replace('\'', '')
-            pose_q = 'belief_at(\'{}\', R).'.format(object_id)
-            believed_pose = self.prolog_query(pose_q)[0]['R']
-            ros_pose = PoseStamped()
-            ros_pose.header.frame_id = believed_pose[0]
-            ros_pose.pose.position = Point(*believed_pose[2])
-            ros_pose.pose.orientation = Quaternion(*believed_pose[3])
-            objects[object_id] = ros_pose
-        return objects
+        def load():
+            q = 'findall([R, P], (rdfs_individual_of(R, {}), once(belief_at(R, P))), Rs)'.format(type)
+            solutions = self.prolog_first(q)['Rs']
+            object_ids = [object_id.replace('\'', '') for object_id, _ in solutions]
+            positions = np.array([pose[2] for _, pose in solutions], dtype=float).reshape(-1, 3)
+            orientations = np.array([pose[3] for _, pose in solutions], dtype=float).reshape(-1, 4)
+            poses = [Pose(pose[0], position, orientation)
+                     for (_, pose), position, orientation in zip(solutions, positions, orientations)]
+            return OrderedDict(zip(object_ids, poses))
+        # new messages, because callers modify the returned poses
+        return OrderedDict((object_id, pose.to_msg())
+                           for object_id, pose in self.cache.get('objects', type, load).items())
 
     def get_shelves(self):
         return self.get_objects(SHELF_METER)
 
+    def publish_static_frames(self, object_ids):
+        """
+        Sends the believed poses of the object frames of object_ids on /tf_static, if static_shelf_frames is set.
+        """
+        if not self.static_shelf_frames or len(object_ids) == 0:
+            return
+        q = 'findall([F, P], (member(O, [{}]), object_frame_name(O, F), once(belief_at(O, P))), Fs)'.format(
+            ','.join('\'{}\''.format(object_id.replace('\'', '')) for object_id in object_ids))
+        solution = self.prolog_first(q)
+        if solution is None:
+            rospy.logwarn('failed to get the frames of {}'.format(object_ids))
+            return
+        for frame_id, pose in solution['Fs']:
+            self.tf.add_frame_from_pose(frame_id.replace('\'', ''), Pose.from_prolog(pose).to_msg(), static=True)
+
     def get_perceived_frame_id(self, object_id):
-        if object_id not in self.perceived_frame_id_map:
+        def load():
             q = 'object_perception_affordance_frame_name(\'{}\', F)'.format(object_id)
-            self.perceived_frame_id_map[object_id] = self.prolog_query(q)[0]['F'].replace('\'', '')
-        return self.perceived_frame_id_map[object_id]
+            return self.prolog_first(q)['F'].replace('\'', '')
+        return self.cache.get('perceived_frame_id', object_id, load)
 
     def get_object_frame_id(self, object_id):
-        q = 'object_frame_name(\'{}\', R).'.format(object_id)
-        return self.prolog_query(q)[0]['R'].replace('\'', '')
+        def load():
+            q = 'object_frame_name(\'{}\', R).'.format(object_id)
+            return self.prolog_first(q)['R'].replace('\'', '')
+        return self.cache.get('object_frame_id', object_id, load)
 
     # floor
     def add_shelf_floors(self, shelf_id, floors):
+        floor_ids = []
         for position in floors:
             if position[1] < 0.13:
                 if position[2] < 0.2:
@@ -247,7 +452,10 @@ class KnowRob(object):
             else:
                 layer_type = SHELF_FLOOR_MOUNTING
             q = 'belief_shelf_part_at(\'{}\', {}, {}, R)'.format(shelf_id, layer_type, position[-1])
-            self.prolog_query(q)
+            floor_ids.extend(solution['R'] for solution in self.prolog_query(q, ordered=True))
+        self.cache.notify(FLOORS_CHANGED)
+        self.cache.notify(OBJECTS_CHANGED)
+        self.publish_static_frames(floor_ids)
         return True
 
     def get_floor_ids(self, shelf_id):
@@ -258,10 +466,11 @@ class KnowRob(object):
         solutions = self.prolog_query(q)
         floors = []
         shelf_frame_id = self.get_perceived_frame_id(shelf_id)
-        for solution in solutions:
+        floor_poses = self.tf.lookup_transforms(shelf_frame_id,
+                                                [solution['Frame'].replace('\'', '') for solution in solutions])
+        for solution, floor_pose in zip(solutions, floor_poses):
             floor_id = solution['Floor'].replace('\'', '')
-            floor_pose = self.tf.lookup_transform(shelf_frame_id, solution['Frame'].replace('\'', ''))
-            if floor_pose.pose.position.z < 1.2:
+            if floor_pose is not None and floor_pose.pose.position.z < 1.2:
                 floors.append((floor_id, floor_pose))
         floors = list(sorted(floors, key=lambda x: x[1].pose.position.z))
         self.floors = OrderedDict(floors)
@@ -281,112 +490,168 @@ class KnowRob(object):
         return self.get_floor_position(floor_id).pose.position.z < 0.16
 
     def is_hanging_foor(self, floor_id):
-        q = 'rdfs_individual_of(\'{}\', {})'.format(floor_id, SHELF_FLOOR_MOUNTING)
-        solutions = self.prolog_query(q)
-        return len(solutions) > 0
+        def load():
+            q = 'rdfs_individual_of(\'{}\', {})'.format(floor_id, SHELF_FLOOR_MOUNTING)
+            return self.prolog_first(q) is not None
+        return self.cache.get('hanging_floor', floor_id, load)
 
     def is_normal_floor(self, floor_id):
         return not self.is_bottom_floor(floor_id) and not self.is_hanging_foor(floor_id)
 
     def add_separators(self, floor_id, separators):
-        for p in separators:
-            q = 'belief_shelf_part_at(\'{}\', {}, {}, _)'.format(floor_id, SEPARATOR, p.pose.position.x)
-            self.prolog_query(q)
-        return True
+        results = self.prolog_batch_query([self.shelf_part_goal(floor_id, SEPARATOR, p.x, False)
+                                           for p in separators])
+        self.cache.notify(SHELF_PARTS_CHANGED, floor_id)
+        return all(results)
 
     def add_barcodes(self, floor_id, barcodes):
-        for barcode, p in barcodes.items():
-            q = 'belief_shelf_barcode_at(\'{}\', {}, dan(\'{}\'), {}, _)'.format(floor_id, BARCODE,
-                                                                                 barcode, p.pose.position.x)
-            self.prolog_query(q)
-
-    def add_separators_and_barcodes(self, floor_id, separators, barcodes):
+        results = self.prolog_batch_query([self.barcode_goal(floor_id, barcode, p.x, False)
+                                           for barcode, p in barcodes.items()])
+        self.cache.notify(SHELF_PARTS_CHANGED, floor_id)
+        return all(results)
+
+    def shelf_part_goal(self, floor_id, part_type, x, normalized=True):
+        if normalized:
+            x = 'norm({})'.format(x)
+        return 'belief_shelf_part_at(\'{}\', {}, {}, _)'.format(floor_id, part_type, x)
+
+    def barcode_goal(self, floor_id, barcode, x, normalized=True):
+        if normalized:
+            x = 'norm({})'.format(x)
+        return 'belief_shelf_barcode_at(\'{}\', {}, dan(\'{}\'), {}, _)'.format(floor_id, BARCODE, barcode, x)
+
+    def add_separators_and_barcodes(self, floor_id, separators, barcodes, log_perception=True):
+        """
+        :param log_perception: if False, log_separator_perception has to be called afterwards,
+                               e.g. because this runs in another thread than the action graph
+        """
         # update floor height
-        new_floor_height = np.mean([self.tf.transform_pose(
-            self.get_perceived_frame_id(floor_id), p).pose.position.z for p in separators])
+        floor_frame_id = self.get_perceived_frame_id(floor_id)
+        new_floor_height = np.mean(self.tf.transform_batch(
+            floor_frame_id, PoseBatch.from_poses(separators, floor_frame_id)).positions[:, 2])
         current_floor_pose = self.tf.lookup_transform(MAP, self.get_object_frame_id(floor_id))
         current_floor_pose.pose.position.z += new_floor_height - 0.01
-        q = 'belief_at_update(\'{}\', {})'.format(floor_id, self.pose_to_prolog(current_floor_pose))
-        self.prolog_query(q)
-
-        for p in separators:
-            q = 'belief_shelf_part_at(\'{}\', {}, norm({}), _)'.format(floor_id, SEPARATOR, p.pose.position.x)
-            self.prolog_query(q)
-
-        for barcode, p in barcodes.items():
-            q = 'belief_shelf_barcode_at(\'{}\', {}, dan(\'{}\'), norm({}), _)'.format(floor_id, BARCODE, barcode,
-                                                                                       p.pose.position.x)
-            self.prolog_query(q)
-
-        self.start_shelf_separator_perception(self.get_separators(floor_id))
-        self.finish_action()
-        self.start_shelf_label_perception(self.get_barcodes(floor_id))
-        self.finish_action()
+        goals = ['belief_at_update(\'{}\', {})'.format(floor_id, self.pose_to_prolog(current_floor_pose))]
+        goals.extend(self.shelf_part_goal(floor_id, SEPARATOR, p.x) for p in separators)
+        goals.extend(self.barcode_goal(floor_id, barcode, p.x) for barcode, p in barcodes.items())
+        self.prolog_batch_query(goals)
+        self.cache.notify(SHELF_PARTS_CHANGED, floor_id)
+        self.cache.notify(POSES_CHANGED)
+        self.publish_static_frames([floor_id])
+        self.tf.invalidate_static_frame(self.get_perceived_frame_id(floor_id))
+        self.tf.invalidate_static_frame(self.get_object_frame_id(floor_id))
+        if log_perception:
+            self.log_separator_perception(floor_id)
+
+    def log_separator_perception(self, floor_id, action=None, t=None):
+        """
+        :param action: ActionGraph node the perception events are added to, None for the current action
+        :param t: unix time at which the shelf parts were perceived, default now
+        """
+        current_action = self.action_graph
+        if action is not None:
+            self.action_graph = action
+        self.start_shelf_separator_perception(self.get_separators(floor_id), t)
+        self.finish_action(t)
+        self.start_shelf_label_perception(self.get_barcodes(floor_id), t)
+        self.finish_action(t)
+        self.action_graph = current_action
 
     def get_separators(self, floor_id):
-        q = 'findall(S, shelf_layer_separator(\'{}\', S), Ss)'.format(floor_id)
-        solutions = self.prolog_query(q)
-        return solutions[0]['Ss']
+        def load():
+            q = 'findall(S, shelf_layer_separator(\'{}\', S), Ss)'.format(floor_id)
+            return self.prolog_first(q)['Ss']
+        return list(self.cache.get('separators', floor_id, load))
 
     def get_mounting_bars(self, floor_id):
-        q = 'findall(S, shelf_layer_mounting_bar(\'{}\', S), Ss)'.format(floor_id)
-        solutions = self.prolog_query(q)
-        return solutions[0]['Ss']
+        def load():
+            q = 'findall(S, shelf_layer_mounting_bar(\'{}\', S), Ss)'.format(floor_id)
+            return self.prolog_first(q)['Ss']
+        return list(self.cache.get('mounting_bars', floor_id, load))
 
     def get_barcodes(self, floor_id):
-        q = 'findall(S, shelf_layer_label(\'{}\', S), Ss)'.format(floor_id)
-        solutions = self.prolog_query(q)
-        return solutions[0]['Ss']
+        def load():
+            q = 'findall(S, shelf_layer_label(\'{}\', S), Ss)'.format(floor_id)
+            return self.prolog_first(q)['Ss']
+        return list(self.cache.get('barcodes', floor_id, load))
 
-    def add_mounting_bars_and_barcodes(self, floor_id, separators, barcodes):
+    def add_mounting_bars_and_barcodes(self, floor_id, separators, barcodes, log_perception=True):
+        """
+        :param log_perception: see add_separators_and_barcodes
+        """
         if len(separators) > 0:
-            for p in separators:
-                q = 'belief_shelf_part_at(\'{}\', {}, norm({}), _)'.format(floor_id, MOUNTING_BAR, p.pose.position.x)
-                self.prolog_query(q)
+            goals = [self.shelf_part_goal(floor_id, MOUNTING_BAR, p.x) for p in separators]
         else:
-            for barcode, p in barcodes.items():
-                q = 'belief_shelf_part_at(\'{}\', {}, norm({}), _)'.format(floor_id, MOUNTING_BAR, p.pose.position.x+0.02)
-                self.prolog_query(q)
-
-        for barcode, p in barcodes.items():
-            q = 'belief_shelf_barcode_at(\'{}\', {}, dan(\'{}\'), norm({}), _)'.format(floor_id, BARCODE, barcode,
-                                                                                       p.pose.position.x)
-            self.prolog_query(q)
-
-        self.start_shelf_bar_perception(self.get_mounting_bars(floor_id))
-        self.finish_action()
-        self.start_shelf_label_perception(self.get_barcodes(floor_id))
-        self.finish_action()
+            goals = [self.shelf_part_goal(floor_id, MOUNTING_BAR, p.x + 0.02) for p in barcodes.values()]
+        goals.extend(self.barcode_goal(floor_id, barcode, p.x) for barcode, p in barcodes.items())
+        self.prolog_batch_query(goals)
+        self.cache.notify(SHELF_PARTS_CHANGED, floor_id)
+        if log_perception:
+            self.log_mounting_bar_perception(floor_id)
+
+    def log_mounting_bar_perception(self, floor_id, action=None, t=None):
+        """
+        :param action: ActionGraph node the perception events are added to, None for the current action
+        :param t: unix time at which the shelf parts were perceived, default now
+        """
+        current_action = self.action_graph
+        if action is not None:
+            self.action_graph = action
+        self.start_shelf_bar_perception(self.get_mounting_bars(floor_id), t)
+        self.finish_action(t)
+        self.start_shelf_label_perception(self.get_barcodes(floor_id), t)
+        self.finish_action(t)
+        self.action_graph = current_action
 
     def get_facings(self, floor_id):
-        q = 'findall([F, P, W, L], (shelf_facing(\'{}\', F), ' \
+        """
+        :return: Facings of floor_id, positions are in the perceived frame of floor_id
+        """
+        q = 'findall([F, P, W, L, Frame], (shelf_facing(\'{}\', F), ' \
             'shelf_facing_product_type(F,P), ' \
             'comp_facingWidth(F,literal(type(_, W))), ' \
-            '(rdf_has(F, shop:leftSeparator, L); rdf_has(F, shop:mountingBarOfFacing, L))),' \
+            '(rdf_has(F, shop:leftSeparator, L); rdf_has(F, shop:mountingBarOfFacing, L)), ' \
+            'object_frame_name(F, Frame)),' \
             'Facings).'.format(floor_id)
-        solutions = self.prolog_query(q)[0]
-        facings = {}
-        for facing_id, product, width, left_separator_id in solutions['Facings']:
-            facing_pose = self.tf.lookup_transform(self.get_perceived_frame_id(floor_id),
-                                                   self.get_object_frame_id(facing_id))
-            facings[facing_id] = (facing_pose, product, float(width), left_separator_id)
-        return facings
+        solutions = self.prolog_first(q)['Facings']
+        frame_ids = [frame_id.replace('\'', '') for _, _, _, _, frame_id in solutions]
+        facing_poses = self.tf.lookup_transforms(self.get_perceived_frame_id(floor_id), frame_ids)
+        facings = [(facing, pose) for facing, pose in zip(solutions, facing_poses) if pose is not None]
+        return Facings(ids=[facing_id for (facing_id, _, _, _, _), _ in facings],
+                       positions=[[p.pose.position.x, p.pose.position.y, p.pose.position.z] for _, p in facings],
+                       widths=[width for (_, _, width, _, _), _ in facings],
+                       products=[product for (_, product, _, _, _), _ in facings],
+                       left_separators=[left_separator for (_, _, _, left_separator, _), _ in facings])
 
     def add_object(self, facing_id):
         q = 'product_spawn_front_to_back(\'{}\', ObjId)'.format(facing_id)
-        self.prolog_query(q)
+        self.prolog_query(q, ordered=True)
+        self.cache.notify(OBJECTS_CHANGED)
+
+    def add_objects(self, facing_counts):
+        """
+        Spawns the products of many facings with one query per PROLOG_BATCH_SIZE facings.
+        :param facing_counts: dict facing id -> number of products in that facing
+        :return: True if all products were spawned
+        """
+        goals = ['forall(between(1, {}, _), product_spawn_front_to_back(\'{}\', _))'.format(count, facing_id)
+                 for facing_id, count in facing_counts.items() if count > 0]
+        results = self.prolog_batch_query(goals)
+        self.cache.notify(OBJECTS_CHANGED)
+        return all(results)
 
     def save_beliefstate(self, path=None):
         if path is None:
             path = '{}/data/beliefstate.owl'.format(RosPack().get_path('refills_first_review'))
         q = 'rdf_save(\'{}\', belief_state)'.format(path)
-        self.prolog_query(q)
+        self.prolog_query(q, ordered=True)
 
     def save_action_graph(self, path=None):
         if path is None:
             path = '{}/data/actions.owl'.format(RosPack().get_path('refills_first_review'))
+        self.action_logger.flush()
         q = 'rdf_save(\'{}\', [graph(\'LoggingGraph\')])'.format(path)
-        self.prolog_query(q)
+        self.prolog_query(q, ordered=True)
 
     def start_everything(self):
         a = 'http://knowrob.org/kb/knowrob.owl#RobotExperiment'
@@ -492,21 +757,21 @@ class KnowRob(object):
         if self.action_graph is not None:
             self.action_graph = self.action_graph.add_sub_motion(a, goal_location=goal_location)
 
-    def start_shelf_separator_perception(self, detected_objects=None):
+    def start_shelf_separator_perception(self, detected_objects=None, t=None):
         a = 'http://knowrob.org/kb/shop.owl#ShelfSeparatorPerception'
         if self.action_graph is not None:
-            self.action_graph = self.action_graph.add_sub_event(a, detected_objects=detected_objects)
+            self.action_graph = self.action_graph.add_sub_event(a, detected_objects=detected_objects, t=t)
 
-    def start_shelf_bar_perception(self, detected_objects=None):
+    def start_shelf_bar_perception(self, detected_objects=None, t=None):
         a = 'http://knowrob.org/kb/shop.owl#ShelfBarPerception'
         if self.action_graph is not None:
-            self.action_graph = self.action_graph.add_sub_event(a, detected_objects=detected_objects)
+            self.action_graph = self.action_graph.add_sub_event(a, detected_objects=detected_objects, t=t)
 
-    def start_shelf_label_perception(self, detected_objects=None):
+    def start_shelf_label_perception(self, detected_objects=None, t=None):
         a = 'http://knowrob.org/kb/shop.owl#ShelfLabelPerception'
         if self.action_graph is not None:
-            self.action_graph = self.action_graph.add_sub_event(a, detected_objects=detected_objects)
+            self.action_graph = self.action_graph.add_sub_event(a, detected_objects=detected_objects, t=t)
 
-    def finish_action(self):
+    def finish_action(self, t=None):
         if self.action_graph is not None:
-            self.action_graph = self.action_graph.finish()
+            self.action_graph = self.action_graph.finish(t)
@@ -0,0 +1,101 @@
+from threading import Lock
+
+import rospy
+from visualization_msgs.msg import Marker, MarkerArray
+
+# max number of marker updates per second
+DEFAULT_MAX_RATE = 5.
+
+_marker_manager = None
+_marker_manager_lock = Lock()
+
+
+class MarkerManager(object):
+    """
+    Keeps the markers of all namespaces and only publishes the ones that were added, changed or deleted,
+    at most max_rate times per second.
+    Markers must not be changed after they were passed to the manager.
+    """
+    def __init__(self, topic='visualization_marker_array', max_rate=DEFAULT_MAX_RATE):
+        self.pub = rospy.Publisher(topic, MarkerArray, queue_size=10)
+        self.lock = Lock()
+        # ns -> id -> Marker, as shown in rviz
+        self.published = {}
+        # ns -> id -> Marker, None for markers that have to be deleted
+        self.changes = {}
+        self.timer = rospy.Timer(rospy.Duration(1. / max_rate), self.publish_cb)
+
+    def update(self, ns, markers):
+        """
+        Adds or modifies markers of ns, ns and id of the markers are overwritten.
+        :type markers: dict id -> Marker
+        """
+        with self.lock:
+            self.add_changes(ns, markers)
+
+    def add_changes(self, ns, markers):
+        published = self.published.get(ns, {})
+        changes = self.changes.setdefault(ns, {})
+        for id, marker in markers.items():
+            marker.ns = ns
+            marker.id = id
+            marker.action = Marker.ADD
+            if not published.get(id) == marker:
+                changes[id] = marker
+            else:
+                changes.pop(id, None)
+
+    def set(self, ns, markers):
+        """
+        Like update, but also deletes all other markers of ns.
+        """
+        with self.lock:
+            published = self.published.get(ns, {})
+            changes = self.changes.setdefault(ns, {})
+            for id in list(changes):
+                if id not in markers:
+                    del changes[id]
+            for id in published:
+                if id not in markers:
+                    changes[id] = None
+            self.add_changes(ns, markers)
+
+    def clear(self, ns):
+        self.set(ns, {})
+
+    def publish_cb(self, event):
+        self.publish()
+
+    def publish(self):
+        """
+        Publishes the pending changes as one MarkerArray.
+        """
+        with self.lock:
+            ma = MarkerArray()
+            for ns, changes in self.changes.items():
+                published = self.published.setdefault(ns, {})
+                for id, marker in changes.items():
+                    if marker is None:
+                        marker = Marker()
+                        marker.ns = ns
+                        marker.id = id
+                        marker.action = Marker.DELETE
+                        del published[id]
+                    else:
+                        published[id] = marker
+                    ma.markers.append(marker)
+            self.changes = {}
+        if len(ma.markers) > 0:
+            self.pub.publish(ma)
+
+
+def get_marker_manager():
+    """
+    :return: the MarkerManager that is shared by all detectors of this process
+    :rtype: MarkerManager
+    """
+    global _marker_manager
+    with _marker_manager_lock:
+        if _marker_manager is None:
+            _marker_manager = MarkerManager(max_rate=rospy.get_param('~marker_rate', DEFAULT_MAX_RATE))
+        return _marker_manager
@@ -0,0 +1,106 @@
+import numpy as np
+from geometry_msgs.msg import PoseStamped
+
+IDENTITY = (0., 0., 0., 1.)
+
+
+class Pose(object):
+    """
+    Lightweight pose used inside the detection and belief state pipelines.
+    Only converted to PoseStamped where messages are needed.
+    """
+    __slots__ = ['frame_id', 'position', 'orientation']
+
+    def __init__(self, frame_id, position, orientation=IDENTITY):
+        """
+        :param position: [x, y, z]
+        :param orientation: quaternion [x, y, z, w]
+        """
+        self.frame_id = frame_id
+        self.position = np.asarray(position, dtype=float)
+        self.orientation = np.asarray(orientation, dtype=float)
+
+    @classmethod
+    def from_msg(cls, pose_stamped):
+        p = pose_stamped.pose.position
+        q = pose_stamped.pose.orientation
+        return cls(pose_stamped.header.frame_id, [p.x, p.y, p.z], [q.x, q.y, q.z, q.w])
+
+    @classmethod
+    def from_prolog(cls, query_result):
+        """
+        :param query_result: [frame_id, _, [x, y, z], [x, y, z, w]]
+        """
+        return cls(query_result[0], query_result[2], query_result[3])
+
+    @property
+    def x(self):
+        return self.position[0]
+
+    def to_msg(self):
+        msg = PoseStamped()
+        msg.header.frame_id = self.frame_id
+        p = msg.pose.position
+        p.x, p.y, p.z = self.position.tolist()
+        q = msg.pose.orientation
+        q.x, q.y, q.z, q.w = self.orientation.tolist()
+        return msg
+
+    def to_prolog(self):
+        return '[\'{}\', _, [{},{},{}], [{},{},{},{}]]'.format(self.frame_id, *(self.position.tolist() +
+                                                                               self.orientation.tolist()))
+
+    def __repr__(self):
+        return 'Pose({!r}, {}, {})'.format(self.frame_id, self.position.tolist(), self.orientation.tolist())
+
+
+class PoseBatch(object):
+    """
+    N poses in one frame, stored as Nx3 positions and Nx4 orientations.
+    """
+    __slots__ = ['frame_id', 'positions', 'orientations']
+
+    def __init__(self, frame_id, positions, orientations=None):
+        """
+        :param orientations: None for identity orientations
+        """
+        self.frame_id = frame_id
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        if orientations is None:
+            orientations = np.tile(IDENTITY, (len(self.positions), 1))
+        self.orientations = np.asarray(orientations, dtype=float).reshape(-1, 4)
+
+    @classmethod
+    def from_poses(cls, poses, frame_id=None):
+        """
+        :type poses: list of Pose, all in frame_id, which defaults to the frame of the first pose
+        """
+        if frame_id is None:
+            frame_id = poses[0].frame_id if len(poses) > 0 else ''
+        return cls(frame_id, [p.position for p in poses], [p.orientation for p in poses])
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        return Pose(self.frame_id, self.positions[i], self.orientations[i])
+
+    def __iter__(self):
+        for position, orientation in zip(self.positions, self.orientations):
+            yield Pose(self.frame_id, position, orientation)
+
+    def select(self, mask):
+        """
+        :param mask: boolean array or indices
+        :return: PoseBatch with the selected rows
+        """
+        return PoseBatch(self.frame_id, self.positions[mask], self.orientations[mask])
+
+    def finite(self):
+        """
+        :return: PoseBatch without the rows that could not be transformed
+        """
+        return self.select(np.isfinite(self.positions[:, 0]))
+
+    def to_msgs(self):
+        return [pose.to_msg() for pose in self]
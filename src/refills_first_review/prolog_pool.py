@@ -0,0 +1,77 @@
+from Queue import Queue
+from threading import Lock
+from time import time
+
+from json_prolog import json_prolog
+
+
+class PrologPool(object):
+    """
+    Pool of json_prolog clients.
+    Independent queries run in parallel on different clients, ordered queries are executed one after another.
+    """
+    def __init__(self, size=4, client_factory=json_prolog.Prolog):
+        """
+        :param size: number of json_prolog clients
+        :param client_factory: function without arguments that returns a new client
+        """
+        self.size = size
+        self.clients = Queue()
+        for i in range(size):
+            client = client_factory()
+            if i == 0:
+                client.wait_for_service()
+            self.clients.put(client)
+        self.ordered_lock = Lock()
+        self.stats_lock = Lock()
+        self.reset_stats()
+
+    def acquire(self, ordered=False):
+        """
+        Blocks until a client is available.
+        :param ordered: if True, also wait until all previously acquired ordered clients have been released
+        :return: (client, seconds spent waiting)
+        """
+        start = time()
+        if ordered:
+            self.ordered_lock.acquire()
+        client = self.clients.get()
+        return client, time() - start
+
+    def release(self, client, ordered=False, wait_time=0, execution_time=0):
+        """
+        :param wait_time: as returned by acquire
+        :param execution_time: seconds the client was used
+        """
+        self.clients.put(client)
+        if ordered:
+            self.ordered_lock.release()
+        with self.stats_lock:
+            self.num_queries += 1
+            self.total_wait_time += wait_time
+            self.total_execution_time += execution_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.max_execution_time = max(self.max_execution_time, execution_time)
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.num_queries = 0
+            self.total_wait_time = 0.
+            self.total_execution_time = 0.
+            self.max_wait_time = 0.
+            self.max_execution_time = 0.
+
+    def get_stats(self):
+        """
+        :return: dict with the number of queries and the total, mean and max queue wait and execution time in s
+        """
+        with self.stats_lock:
+            n = max(self.num_queries, 1)
+            return {'size': self.size,
+                    'queries': self.num_queries,
+                    'wait_time': {'total': self.total_wait_time,
+                                  'mean': self.total_wait_time / n,
+                                  'max': self.max_wait_time},
+                    'execution_time': {'total': self.total_execution_time,
+                                       'mean': self.total_execution_time / n,
+                                       'max': self.max_execution_time}}
@@ -0,0 +1,122 @@
+import json
+import re
+from collections import defaultdict, deque
+from threading import Lock
+from time import sleep
+
+import rospy
+
+# numbers that are tokens on their own, not the digits in names like ID0 or 'shelf_system_1'
+NUMBER = re.compile(r'(?<![\w.])-?\d+(\.\d+)?([eE][-+]?\d+)?(?!\w|\.\d)')
+
+
+def normalize_query(q):
+    """
+    Masks all numbers in q, such that queries that only differ in poses or time stamps can be matched.
+    """
+    return NUMBER.sub('#', q)
+
+
+class PrologRecorder(object):
+    """
+    Appends every prolog query and its solutions as one json object per line to a log file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.log = open(path, 'a')
+
+    def record(self, q, solutions, execution_time):
+        """
+        :param solutions: list of raw solutions as returned by json_prolog
+        :param execution_time: seconds it took to get the solutions
+        """
+        line = json.dumps({'q': q, 's': solutions, 't': round(execution_time, 5)}, separators=(',', ':'))
+        with self.lock:
+            self.log.write(line + '\n')
+            self.log.flush()
+
+    def close(self):
+        with self.lock:
+            self.log.close()
+
+
+class PrologReplay(object):
+    """
+    Answers prolog queries with the solutions from a log written by PrologRecorder, without json_prolog.
+    Queries are matched exactly, or with masked numbers if there is no exact match.
+    Repeated queries get the recorded answers in the recorded order.
+    """
+    def __init__(self, path, latency=0., time_scale=0.):
+        """
+        :param latency: seconds every query is delayed
+        :param time_scale: additionally delay every query by time_scale * recorded execution time
+        """
+        self.latency = latency
+        self.time_scale = time_scale
+        self.lock = Lock()
+        self.answers = defaultdict(deque)
+        self.normalized_answers = defaultdict(deque)
+        with open(path) as log:
+            for line in log:
+                if line.strip() == '':
+                    continue
+                entry = json.loads(line)
+                entry['used'] = False
+                self.answers[entry['q']].append(entry)
+                self.normalized_answers[normalize_query(entry['q'])].append(entry)
+        rospy.loginfo('loaded {} recorded prolog queries from {}'.format(sum(len(x) for x in self.answers.values()),
+                                                                         path))
+
+    def pop_unused(self, entries):
+        while entries:
+            entry = entries.popleft()
+            if not entry['used']:
+                entry['used'] = True
+                return entry
+
+    def pop_answer(self, q):
+        """
+        :return: (recorded solutions, recorded execution time)
+        """
+        with self.lock:
+            entry = self.pop_unused(self.answers.get(q))
+            if entry is None:
+                entry = self.pop_unused(self.normalized_answers.get(normalize_query(q)))
+        if entry is None:
+            rospy.logwarn('no recorded answer for {}'.format(q))
+            return [], 0.
+        return entry['s'], entry['t']
+
+    def client(self):
+        """
+        :return: object with the interface of json_prolog.Prolog
+        """
+        return ReplayProlog(self)
+
+
+class ReplayProlog(object):
+    def __init__(self, replay):
+        self.replay = replay
+
+    def wait_for_service(self, timeout=None):
+        pass
+
+    def query(self, q):
+        solutions, execution_time = self.replay.pop_answer(q)
+        delay = self.replay.latency + self.replay.time_scale * execution_time
+        if delay > 0:
+            sleep(delay)
+        return ReplayQuery(solutions)
+
+
+class ReplayQuery(object):
+    def __init__(self, solutions):
+        self._solutions = solutions
+
+    def solutions(self):
+        for solution in self._solutions:
+            yield solution
+
+    def finish(self):
+        pass
@@ -0,0 +1,134 @@
+import json
+import re
+from collections import defaultdict
+from threading import Lock
+
+FUNCTOR = re.compile(r'([a-z][A-Za-z0-9_]*)\s*\(')
+# meta predicates, the name of the first wrapped goal is added to their name
+META_PREDICATES = ['findall', 'once', 'catch', 'forall']
+# one goal of a batch, see KnowRob.prolog_batch
+BATCH_GOAL = re.compile(r'\(catch\(\((.*?)\), _, fail\) -> S\d+ = 1 ; S\d+ = 0\)')
+
+# upper bounds of the histogram buckets in s, the last bucket collects everything above
+BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5., 10.]
+
+
+def predicate_head(q):
+    """
+    :param q: prolog query
+    :return: name of the first predicate, e.g. 'belief_shelf_part_at' or 'findall/shelf_facing'.
+             Batches are named 'batch/' and the name of their goals, or just 'batch' if the goals differ.
+    """
+    if q.startswith('(catch(('):
+        heads = set(goal_head(goal) for goal in BATCH_GOAL.findall(q))
+        if len(heads) == 1:
+            return 'batch/{}'.format(heads.pop())
+        return 'batch'
+    return goal_head(q)
+
+
+def goal_head(q):
+    names = []
+    for match in FUNCTOR.finditer(q):
+        names.append(match.group(1))
+        if match.group(1) not in META_PREDICATES:
+            break
+    if len(names) == 0:
+        return q.strip()
+    return '/'.join(names)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.num = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        for i, upper_bound in enumerate(BUCKETS):
+            if value <= upper_bound:
+                break
+        else:  # if not break
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.num += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        :return: upper bound of the bucket that contains the p-th percentile, max for the last bucket
+        """
+        if self.num == 0:
+            return 0.
+        threshold = p / 100. * self.num
+        count = 0
+        for i, c in enumerate(self.counts):
+            count += c
+            if count >= threshold:
+                break
+        if i < len(BUCKETS):
+            return min(BUCKETS[i], self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'total': self.total,
+                'mean': self.total / max(self.num, 1),
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'buckets': BUCKETS,
+                'counts': self.counts}
+
+
+class PredicateStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.solutions = 0
+        self.wall_time = Histogram()
+        self.wait_time = Histogram()
+
+    def to_dict(self):
+        return {'calls': self.calls,
+                'solutions': self.solutions,
+                'wall_time': self.wall_time.to_dict(),
+                'wait_time': self.wait_time.to_dict()}
+
+
+class PrologStats(object):
+    """
+    Latency statistics of prolog queries, grouped by predicate head.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.predicates = defaultdict(PredicateStats)
+
+    def add(self, q, wall_time, wait_time, num_solutions):
+        """
+        :param wall_time: seconds from sending q until the query was finished, including wait_time
+        :param wait_time: seconds q waited for a prolog client
+        """
+        head = predicate_head(q)
+        with self.lock:
+            stats = self.predicates[head]
+            stats.calls += 1
+            stats.solutions += num_solutions
+            stats.wall_time.add(wall_time)
+            stats.wait_time.add(wait_time)
+
+    def get_report(self):
+        """
+        :return: list of (predicate head, stats dict), ordered by total wall time
+        """
+        with self.lock:
+            report = [(head, stats.to_dict()) for head, stats in self.predicates.items()]
+        return sorted(report, key=lambda x: -x[1]['wall_time']['total'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.get_report(), f, indent=2)
@@ -13,6 +13,7 @@ from std_srvs.srv import SetBool, SetBoolRequest
 
 from refills_first_review.barcode_detection import BarcodeDetector
 from refills_first_review.baseboard_detection import BaseboardDetector
+from refills_first_review.futures import Worker
 from refills_first_review.separator_detection import SeparatorClustering
 from refills_first_review.tfwrapper import TfWrapper
 
@@ -34,6 +35,11 @@ class RoboSherlock(object):
         self.separator_detection = SeparatorClustering(knowrob)
         self.baseboard_detection = BaseboardDetector()
         self.barcode_detection = BarcodeDetector(knowrob)
+        # cluster detections after a detector was stopped
+        self.separator_worker = Worker('separator processing')
+        self.barcode_worker = Worker('barcode processing')
+        self.separator_future = None
+        self.barcode_future = None
         self.ring_light_srv = rospy.ServiceProxy('ring_light_switch/setbool', SetBool)
         self.floor_detection = True
         try:
@@ -55,16 +61,34 @@ class RoboSherlock(object):
         except:
             rospy.logwarn('ring_light_switch not available')
 
+    def wait_for(self, future):
+        """
+        Detectors are reused for the next floor, therefore they have to finish processing the last one first.
+        """
+        if future is not None:
+            future.exception()
+
     def start_separator_detection(self, floor_id):
         self.set_ring_light(True)
+        self.wait_for(self.separator_future)
         self.separator_detection.start_listening_separators(floor_id)
 
     def start_mounting_bar_detection(self, floor_id):
         self.set_ring_light(True)
+        self.wait_for(self.separator_future)
         self.separator_detection.start_listening_mounting_bars(floor_id)
 
     def stop_separator_detection(self):
-        return self.separator_detection.stop_listening()
+        return self.stop_separator_detection_async().result()
+
+    def stop_separator_detection_async(self):
+        """
+        Stops listening right away and clusters the detections in the background.
+        :return: Future of the separators
+        """
+        self.separator_detection.stop_receiving()
+        self.separator_future = self.separator_worker.submit(self.separator_detection.process_detections)
+        return self.separator_future
 
     def start_baseboard_detection(self):
         self.set_ring_light(True)
@@ -75,11 +99,21 @@ class RoboSherlock(object):
 
     def start_barcode_detection(self, shelf_id, floor_id):
         self.set_ring_light(True)
+        self.wait_for(self.barcode_future)
         self.barcode_detection.start_listening(shelf_id, floor_id)
         pass
 
     def stop_barcode_detection(self):
-        return self.barcode_detection.stop_listening()
+        return self.stop_barcode_detection_async().result()
+
+    def stop_barcode_detection_async(self):
+        """
+        Stops listening right away and clusters the barcodes in the background.
+        :return: Future of the barcodes
+        """
+        self.barcode_detection.stop_receiving()
+        self.barcode_future = self.barcode_worker.submit(self.barcode_detection.process_detections)
+        return self.barcode_future
 
     def detect_floors(self, shelf_id):
         # TODO
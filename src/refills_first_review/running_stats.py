@@ -0,0 +1,108 @@
+from __future__ import division
+
+from random import randint
+
+import numpy as np
+
+# number of positions that are kept for the median
+RESERVOIR_SIZE = 32
+# positions further away from the median than this many median absolute deviations are outliers
+OUTLIER_THRESHOLD = 3.
+# spread in m at which the confidence dropped to 1/e
+CONFIDENCE_SPREAD = 0.02
+# number of sightings needed for full confidence
+CONFIDENCE_COUNT = 5
+
+
+class RunningPosition(object):
+    """
+    Aggregates many sightings of the same object in constant memory.
+    Keeps count, mean and variance with Welford's algorithm and a uniform random sample for the median.
+    The median and the median absolute deviation of the sample are only used to reject outliers,
+    the position is the mean of all sightings that were not rejected.
+    """
+    __slots__ = ['count', 'mean', 'm2', 'reservoir', 'bounds', 'inlier_count', 'inlier_sum']
+
+    def __init__(self):
+        self.count = 0
+        self.mean = np.zeros(3)
+        self.m2 = np.zeros(3)
+        self.reservoir = []
+        # (median, max distance of inliers) of the reservoir, None if the reservoir changed
+        self.bounds = None
+        # sightings that were inliers when they were added, only used once the reservoir is full
+        self.inlier_count = 0
+        self.inlier_sum = np.zeros(3)
+
+    def add(self, position):
+        """
+        O(1) update with one sighting.
+        :param position: [x, y, z]
+        """
+        position = np.asarray(position, dtype=float)
+        self.count += 1
+        delta = position - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (position - self.mean)
+        if len(self.reservoir) < RESERVOIR_SIZE:
+            self.reservoir.append(position)
+            self.bounds = None
+            if len(self.reservoir) == RESERVOIR_SIZE:
+                inliers = self.inliers(np.array(self.reservoir))
+                self.inlier_count = len(inliers)
+                self.inlier_sum = inliers.sum(axis=0)
+        else:
+            median, max_distance = self.get_bounds()
+            if np.linalg.norm(position - median) <= max_distance:
+                self.inlier_count += 1
+                self.inlier_sum += position
+            i = randint(0, self.count - 1)
+            if i < RESERVOIR_SIZE:
+                self.reservoir[i] = position
+                self.bounds = None
+
+    def get_bounds(self):
+        """
+        :return: median of the reservoir and the max distance to it of positions that are not outliers
+        """
+        if self.bounds is None:
+            samples = np.array(self.reservoir)
+            median = np.median(samples, axis=0)
+            mad = np.median(np.linalg.norm(samples - median, axis=1))
+            self.bounds = (median, OUTLIER_THRESHOLD * mad)
+        return self.bounds
+
+    def inliers(self, samples):
+        median, max_distance = self.get_bounds()
+        return samples[np.linalg.norm(samples - median, axis=1) <= max_distance]
+
+    def variance(self):
+        if self.count < 2:
+            return np.zeros(3)
+        return self.m2 / (self.count - 1)
+
+    def spread(self):
+        """
+        :return: standard deviation of the distance to the mean in m
+        """
+        return np.sqrt(self.variance().sum())
+
+    def confidence(self):
+        """
+        :return: value in [0, 1], low for barcodes that were rarely seen or seen at very different positions
+        """
+        return min(1., self.count / CONFIDENCE_COUNT) * np.exp(-self.spread() / CONFIDENCE_SPREAD)
+
+    def position(self):
+        """
+        :return: mean of the positions that are not outliers around the median
+        """
+        if self.count < RESERVOIR_SIZE:
+            # the reservoir still holds all sightings
+            inliers = self.inliers(np.array(self.reservoir))
+            if len(inliers) == 0:
+                return self.get_bounds()[0]
+            return inliers.mean(axis=0)
+        if self.inlier_count == 0:
+            return self.get_bounds()[0]
+        return self.inlier_sum / self.inlier_count
@@ -1,124 +1,204 @@
 from __future__ import division, print_function
 
+import json
+
 from sklearn.cluster import DBSCAN
 
 import rospy
 import numpy as np
 
-from copy import deepcopy
-from geometry_msgs.msg import Point, Vector3, PoseStamped, Quaternion
+from geometry_msgs.msg import Vector3
 from refills_msgs.msg import SeparatorArray
 from rospy import ROSException
 from std_msgs.msg import ColorRGBA
 from tf.transformations import quaternion_about_axis
-from visualization_msgs.msg import Marker, MarkerArray
+from visualization_msgs.msg import Marker
 
+from refills_first_review.deferred_transformer import DeferredTransformer
+from refills_first_review.detection_buffer import DetectionBuffer
+from refills_first_review.interval_clustering import IntervalClustering
 from refills_first_review.knowrob_wrapper import KnowRob
+from refills_first_review.marker_manager import get_marker_manager
+from refills_first_review.poses import Pose
 from refills_first_review.tfwrapper import TfWrapper
 
+SEPARATOR_ORIENTATION = quaternion_about_axis(-np.pi / 2, [0, 0, 1])
+
+# values of ~separator_clustering
+# online clusters the x coordinates while the detections arrive. It only matches DBSCAN on the x coordinates and
+# merges separators that DBSCAN on the positions keeps apart because of their scatter in y and z, which is why it has
+# to be enabled explicitly, see scripts/separator_clustering_evaluation.py
+ONLINE = 'online'
+DBSCAN_CLUSTERING = 'dbscan'
+
 
 class SeparatorClustering(object):
     def __init__(self, knowrob):
         self.knowrob = knowrob
         # TODO use paramserver [low]
         self.tf = TfWrapper(6)
-        self.marker_pub = rospy.Publisher('visualization_marker_array', MarkerArray, queue_size=10)
-        self.detections = []
+        self.markers = get_marker_manager()
+        # detections closer than this are merged before dbscan, 0 keeps all of them
+        self.voxel_size = rospy.get_param('~separator_voxel_size', 0.002)
+        self.detections = DetectionBuffer(self.voxel_size)
         self.map_frame_id = 'map'
         self.separator_maker_color = ColorRGBA(.8, .8, .8, .8)
         self.separator_maker_scale = Vector3(.01, .5, .05)
         self.min_samples = 1
         self.max_dist = 0.02
+        self.interval_clustering = IntervalClustering(self.max_dist, self.min_samples)
+        self.clustering = rospy.get_param('~separator_clustering', DBSCAN_CLUSTERING)
+        # if set, the detections of every floor are appended to this file
+        self.record_path = rospy.get_param('~separator_detections_path', None)
         self.hanging = False
         self.listen = False
+        self.transformer = DeferredTransformer(self.tf, 'separator detection', self.add_detections,
+                                               via=self.map_frame_id)
         self.separator_sub = rospy.Subscriber('/separator_marker_detector_node/data_out', SeparatorArray, self.separator_cb,
                                               queue_size=10)
 
-    def start_listening_separators(self, floor_id, topic='/separator_marker_detector_node/data_out'):
-        self.hanging = False
+    def start_listening_separators(self, floor_id, topic='/separator_marker_detector_node/data_out', hanging=False):
+        self.hanging = hanging
         # self.topic = topic
         self.current_floor_id = floor_id
-        self.listen = True
-        self.detections = []
+        self.tf.add_static_frame(self.knowrob.get_perceived_frame_id(floor_id))
+        self.transformer.reset_stats()
+        self.detections.clear()
+        self.interval_clustering = IntervalClustering(self.max_dist, self.min_samples)
+        if not self.hanging:
+            self.hacky()
         self.marker_ns = 'separator_{}'.format(floor_id)
+        self.listen = True
 
     def start_listening_mounting_bars(self, floor_id):
-        self.start_listening_separators(floor_id, topic='/muh')
-        self.hanging = True
+        self.start_listening_separators(floor_id, topic='/muh', hanging=True)
 
     def stop_listening(self):
+        self.stop_receiving()
+        return self.process_detections()
+
+    def stop_receiving(self):
+        """
+        Stops adding detections. Returns once all received detections are transformed.
+        """
         self.listen = False
+        self.transformer.flush()
+        self.transformer.log_stats()
         # self.separator_sub.unregister()
+
+    def process_detections(self):
+        """
+        :return: list of Pose of the separators, in the perceived frame of the floor
+        """
         try:
             rospy.wait_for_message('/refills_wrist_camera/image_color', rospy.AnyMsg, timeout=1)
         except ROSException as e:
             rospy.loginfo('camera offline; \'detecting\' separators anyway')
             self.fake_detection()
+        if self.record_path is not None:
+            self.record()
         separators = self.cluster()
+        self.publish_as_marker(separators)
         return separators
 
     def separator_cb(self, separator_array):
         if self.listen:
             frame_id = self.knowrob.get_perceived_frame_id(self.current_floor_id)
-            for separator in separator_array.separators:
-                p = self.tf.transform_pose(frame_id, separator.separator_pose)
-                if p is not None and 0.04 <= p.pose.position.x and p.pose.position.x <= 0.96:
-                    self.detections.append([p.pose.position.x, p.pose.position.y, p.pose.position.z])
+            self.transformer.add(frame_id, [s.separator_pose for s in separator_array.separators])
+
+    def add_detections(self, batch, payload):
+        positions = batch.finite().positions
+        positions = positions[(0.04 <= positions[:, 0]) & (positions[:, 0] <= 0.96)]
+        self.add_positions(positions)
+
+    def add_positions(self, positions, weight=1):
+        """
+        :param positions: Nx3 positions in the perceived frame of the current floor
+        :param weight: number of detections at each position
+        """
+        if self.clustering == ONLINE:
+            self.interval_clustering.add_batch(positions, weight)
+        if self.clustering == DBSCAN_CLUSTERING or self.record_path is not None:
+            self.detections.add(positions, weight)
 
     def cluster(self):
-        if not self.hanging:
-            self.hacky()
-        data = np.array(self.detections)
+        if self.clustering == ONLINE:
+            clusters = self.interval_clustering.get_clusters()
+        else:
+            clusters = self.dbscan()
         separators = []
         old_frame_id = self.knowrob.get_perceived_frame_id(self.current_floor_id)
-        if len(data) == 0:
+        if len(clusters) == 0:
             rospy.logwarn('no separators detected')
         else:
-            clusters = DBSCAN(eps=self.max_dist, min_samples=self.min_samples).fit(data)
-            labels = np.unique(clusters.labels_)
-            rospy.loginfo('detected {} separators'.format(len(labels)))
-            for i, label in enumerate(labels):
-                if label != -1:
-                    separator = PoseStamped()
-                    separator.header.frame_id = old_frame_id
-                    separator.pose.position = Point(*self.cluster_to_separator(data[clusters.labels_ == label]))
-                    separator.pose.orientation = Quaternion(*quaternion_about_axis(-np.pi / 2, [0, 0, 1]))
-                    if 0.0 <= separator.pose.position.x and separator.pose.position.x <= 1:
-                        separators.append(separator)
-
+            rospy.loginfo('detected {} separators'.format(len(clusters)))
+            for position, _ in clusters:
+                separator = Pose(old_frame_id, position, SEPARATOR_ORIENTATION)
+                if 0.0 <= separator.x and separator.x <= 1:
+                    separators.append(separator)
         return separators
 
-    def cluster_to_separator(self, separator_cluster):
-        return separator_cluster.mean(axis=0)
+    def dbscan(self):
+        """
+        :return: list of (weighted mean position, weight) of all clusters
+        """
+        data = self.detections.get_positions()
+        weights = self.detections.get_weights()
+        if len(data) == 0:
+            return []
+        rospy.loginfo('clustering {} of {} separator detections'.format(len(data), self.detections.num_detections))
+        clusters = DBSCAN(eps=self.max_dist, min_samples=self.min_samples).fit(data, sample_weight=weights)
+        result = []
+        for label in np.unique(clusters.labels_):
+            if label != -1:
+                mask = clusters.labels_ == label
+                result.append((self.cluster_to_separator(data[mask], weights[mask]), weights[mask].sum()))
+        return result
+
+    def publish_as_marker(self, separators):
+        markers = {}
+        for i, separator in enumerate(separators):
+            m = Marker()
+            m.header.frame_id = separator.frame_id
+            m.type = Marker.CUBE
+            m.pose = separator.to_msg().pose
+            m.scale = self.separator_maker_scale
+            m.color = self.separator_maker_color
+            markers[i] = m
+        self.markers.set(self.marker_ns, markers)
+
+    def cluster_to_separator(self, separator_cluster, weights):
+        return np.average(separator_cluster, axis=0, weights=weights)
+
+    def record(self):
+        """
+        Appends the detections of the current floor, after voxel downsampling, to record_path,
+        see scripts/separator_clustering_evaluation.py
+        """
+        with open(self.record_path, 'a') as f:
+            f.write(json.dumps({'floor_id': self.current_floor_id,
+                                'max_dist': self.max_dist,
+                                'min_samples': self.min_samples,
+                                'detections': self.detections.get_positions().tolist(),
+                                'weights': self.detections.get_weights().tolist()}) + '\n')
 
     def fake_detection(self):
         if not self.hanging:
             num_fake_separators = 15
-            frame_id = self.knowrob.get_perceived_frame_id(self.current_floor_id)
             for i in range(num_fake_separators):
                 for j in range(self.min_samples + 1):
-                    p = PoseStamped()
-                    p.header.frame_id = frame_id
                     if self.hanging:
-                        p.pose.position.x = (i+0.5) / (num_fake_separators-1)
+                        x = (i+0.5) / (num_fake_separators-1)
                     else:
-                        p.pose.position.x = i / (num_fake_separators - 1)
-                    p.pose.position.y = 0
-                    p.pose.orientation = Quaternion(0, 0, 0, 1)
+                        x = i / (num_fake_separators - 1)
                     if (self.hanging and i < num_fake_separators - 1) or not self.hanging:
-                        self.detections.append([p.pose.position.x, p.pose.position.y, p.pose.position.z])
+                        self.add_positions([[x, 0., 0.]])
 
     def hacky(self):
-        for i in range(200):
-            self.detections.append([0,0,0])
-            self.detections.append([1,0,0])
-        for i in range(20):
-            self.detections.append([0.01,0,0])
-            self.detections.append([0.99,0,0])
-            # self.detections.append([0.02,0,0])
-            # self.detections.append([0.98,0,0])
-            # self.detections.append([0.03,0,0])
-            # self.detections.append([0.97,0,0])
+        self.add_positions([[0, 0, 0], [1, 0, 0]], 200)
+        self.add_positions([[0.01, 0, 0], [0.99, 0, 0]], 20)
+        # self.add_positions([[0.02, 0, 0], [0.98, 0, 0]])
+        # self.add_positions([[0.03, 0, 0], [0.97, 0, 0]])
 
 
 if __name__ == '__main__':
@@ -1,21 +1,202 @@
-import tf
+from collections import OrderedDict
+
+import numpy as np
 import rospy
 from geometry_msgs.msg import PoseStamped, Transform, TransformStamped
 from tf2_geometry_msgs import do_transform_pose
-from tf2_py._tf2 import ExtrapolationException
+from tf2_py._tf2 import ExtrapolationException, LookupException, ConnectivityException
+from tf.transformations import quaternion_matrix, quaternion_from_matrix
+from tf2_msgs.msg import TFMessage
 from tf2_ros import Buffer, TransformListener, StaticTransformBroadcaster
-from multiprocessing import Lock
+from multiprocessing import Lock, TimeoutError
+
+from refills_first_review.futures import Future, wait_all
+from refills_first_review.poses import PoseBatch
+
+# seconds of tf history that are kept by the shared buffer, can be increased with ~tf_buffer_size
+DEFAULT_BUFFER_SIZE = 10
+
+# seconds after invalidate_static_frame during which transforms of the frame are not cached, because the buffer
+# may still hold the old transform until the new one is published, can be changed with ~tf_static_cache_grace
+DEFAULT_STATIC_CACHE_GRACE = 2.
+
+# frames that never move
+WORLD_FRAMES = ['map']
+
+_shared_tf = None
+_shared_tf_lock = Lock()
+
+
+def transform_to_matrix(transform):
+    """
+    :type transform: TransformStamped
+    :return: 4x4 homogeneous transformation matrix
+    """
+    t = transform.transform.translation
+    r = transform.transform.rotation
+    m = quaternion_matrix([r.x, r.y, r.z, r.w])
+    m[:3, 3] = [t.x, t.y, t.z]
+    return m
+
+
+def quaternion_multiply_batch(q, qs):
+    """
+    :param q: quaternion [x, y, z, w]
+    :param qs: Nx4 array of quaternions
+    :return: Nx4 array of the products q * qs[i]
+    """
+    x1, y1, z1, w1 = q
+    x2, y2, z2, w2 = qs[:, 0], qs[:, 1], qs[:, 2], qs[:, 3]
+    return np.stack([w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                     w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                     w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+                     w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2], axis=1)
+
+
+class NotifyingTransformListener(TransformListener):
+    """
+    TransformListener that calls on_update after each tf message was added to the buffer.
+    """
+    def __init__(self, buffer, on_update):
+        self.on_update = on_update
+        super(NotifyingTransformListener, self).__init__(buffer)
+
+    def callback(self, data):
+        super(NotifyingTransformListener, self).callback(data)
+        self.on_update()
+
+    def static_callback(self, data):
+        super(NotifyingTransformListener, self).static_callback(data)
+        self.on_update()
+
+
+class PendingLookup(object):
+    def __init__(self, target_frame, source_frame, stamp, deadline, pose=None):
+        """
+        :param pose: PoseStamped that is transformed, if None the transform itself is the result
+        """
+        self.target_frame = target_frame
+        self.source_frame = source_frame
+        self.stamp = stamp
+        self.deadline = deadline
+        self.pose = pose
+        self.future = Future()
+
+    def try_resolve(self, buffer, now):
+        """
+        :return: True if the future was resolved
+        """
+        try:
+            if not buffer.can_transform(self.target_frame, self.source_frame, self.stamp):
+                if now > self.deadline:
+                    self.future.set_exception(TimeoutError('lookup of {} in {} timed out'.format(self.source_frame,
+                                                                                                self.target_frame)))
+                    return True
+                return False
+            transform = buffer.lookup_transform(self.target_frame, self.source_frame, self.stamp)
+        except (ExtrapolationException, LookupException, ConnectivityException) as e:
+            self.future.set_exception(e)
+            return True
+        if self.pose is None:
+            p = PoseStamped()
+            p.header = transform.header
+            p.pose.position = transform.transform.translation
+            p.pose.orientation = transform.transform.rotation
+            self.future.set_result(p)
+        else:
+            self.future.set_result(do_transform_pose(self.pose, transform))
+        return True
+
+
+class SharedTf(object):
+    """
+    Tf buffer, listener and static broadcaster that are shared by all TfWrappers of a process.
+    """
+    def __init__(self, buffer_size, static_cache_grace=DEFAULT_STATIC_CACHE_GRACE):
+        self.buffer_size = buffer_size
+        self.buffer = Buffer(rospy.Duration(buffer_size))
+        self.pending_lookups = []
+        self.pending_lookups_lock = Lock()
+        self.listener = NotifyingTransformListener(self.buffer, self.resolve_pending_lookups)
+        # expires pending lookups when no tf messages arrive
+        self.pending_lookups_timer = rospy.Timer(rospy.Duration(0.1), lambda event: self.resolve_pending_lookups())
+        self.static_broadcaster = StaticTransformBroadcaster()
+        self.static_transforms = OrderedDict()
+        self.static_transforms_lock = Lock()
+        self.static_frames = set(WORLD_FRAMES)
+        self.static_cache = {}
+        self.static_cache_grace = rospy.Duration(static_cache_grace)
+        # frame id -> time of the last invalidation, for frames that may still be in their grace period
+        self.invalidated_frames = {}
+        self.static_cache_hits = 0
+        self.static_cache_misses = 0
+        self.static_lock = Lock()
+
+    def add_pending_lookup(self, lookup):
+        """
+        :type lookup: PendingLookup
+        """
+        with self.pending_lookups_lock:
+            if not lookup.try_resolve(self.buffer, rospy.get_rostime()):
+                self.pending_lookups.append(lookup)
+        return lookup.future
+
+    def resolve_pending_lookups(self):
+        if not self.pending_lookups:
+            return
+        with self.pending_lookups_lock:
+            now = rospy.get_rostime()
+            self.pending_lookups = [x for x in self.pending_lookups if not x.try_resolve(self.buffer, now)]
+
+    def set_static_transform(self, frame):
+        """
+        /tf_static is latched and only keeps the last message of this process, therefore all static
+        transforms are sent together.
+        :type frame: TransformStamped
+        """
+        with self.static_transforms_lock:
+            self.static_transforms[frame.child_frame_id] = frame
+            self.static_broadcaster.sendTransform(list(self.static_transforms.values()))
+
+    def remove_static_transform(self, child_frame_id):
+        with self.static_transforms_lock:
+            if self.static_transforms.pop(child_frame_id, None) is not None:
+                self.static_broadcaster.sendTransform(list(self.static_transforms.values()))
+
+
+def get_shared_tf(buffer_size=0):
+    """
+    Creates the shared tf buffer on the first call.
+    :param buffer_size: min seconds of tf history the caller needs
+    :rtype: SharedTf
+    """
+    global _shared_tf
+    with _shared_tf_lock:
+        if _shared_tf is None:
+            _shared_tf = SharedTf(max(buffer_size, rospy.get_param('~tf_buffer_size', DEFAULT_BUFFER_SIZE)),
+                                  rospy.get_param('~tf_static_cache_grace', DEFAULT_STATIC_CACHE_GRACE))
+            rospy.sleep(0.1)
+        elif buffer_size > _shared_tf.buffer_size:
+            rospy.logwarn('shared tf buffer only keeps {}s, but {}s were requested; '
+                          'increase ~tf_buffer_size'.format(_shared_tf.buffer_size, buffer_size))
+        return _shared_tf
 
 
 class TfWrapper(object):
     def __init__(self, buffer_size=2):
-        self.tfBuffer = Buffer(rospy.Duration(buffer_size))
-        self.tf_listener = TransformListener(self.tfBuffer)
-        self.tf_static = StaticTransformBroadcaster()
+        """
+        :param buffer_size: min seconds of tf history this wrapper needs, the buffer itself is shared
+        """
+        shared_tf = get_shared_tf(buffer_size)
+        self.shared_tf = shared_tf
+        self.tfBuffer = shared_tf.buffer
+        self.tf_listener = shared_tf.listener
+        self.tf_static = shared_tf.static_broadcaster
         self.tf_frequency = rospy.Duration(1.0)
-        self.broadcasting_frames = []
+        self.broadcasting_frames = OrderedDict()
+        # frame name -> True if it is sent on /tf_static
+        self.frame_is_static = {}
         self.broadcasting_frames_lock = Lock()
-        rospy.sleep(0.1)
 
     def transform_pose(self, target_frame, pose):
         try:
@@ -28,35 +209,235 @@ class TfWrapper(object):
         except ExtrapolationException as e:
             rospy.logwarn(e)
 
+    def add_static_frame(self, frame_id):
+        """
+        Declares that frame_id does not move relative to the map until it is invalidated.
+        Transforms between static frames are cached.
+        """
+        with self.shared_tf.static_lock:
+            self.shared_tf.static_frames.add(frame_id)
+
+    def invalidate_static_frame(self, frame_id):
+        """
+        Drops all cached transforms of frame_id, e.g. because it was moved. The frame stays static, but its transforms
+        are only cached again after the grace period, such that the old transform is not cached again.
+        """
+        with self.shared_tf.static_lock:
+            for key in [key for key in self.shared_tf.static_cache if frame_id in key]:
+                del self.shared_tf.static_cache[key]
+            self.shared_tf.invalidated_frames[frame_id] = rospy.get_rostime()
+
+    def remove_static_frame(self, frame_id):
+        self.invalidate_static_frame(frame_id)
+        with self.shared_tf.static_lock:
+            self.shared_tf.static_frames.discard(frame_id)
+            self.shared_tf.invalidated_frames.pop(frame_id, None)
+
+    def get_static_cache_stats(self):
+        """
+        :return: dict with hits, misses and size of the static transform cache
+        """
+        with self.shared_tf.static_lock:
+            return {'hits': self.shared_tf.static_cache_hits,
+                    'misses': self.shared_tf.static_cache_misses,
+                    'size': len(self.shared_tf.static_cache)}
+
+    def lookup_matrix(self, target_frame, source_frame, stamp=None, timeout=2.0):
+        """
+        Transforms between two static frames are served from the cache, stamp is ignored for them.
+        :param stamp: rospy.Time, None for the latest transform
+        :return: 4x4 matrix that transforms points from source_frame to target_frame
+        """
+        shared_tf = self.shared_tf
+        key = (target_frame, source_frame)
+        with shared_tf.static_lock:
+            static = target_frame in shared_tf.static_frames and source_frame in shared_tf.static_frames
+            if static:
+                if key in shared_tf.static_cache:
+                    shared_tf.static_cache_hits += 1
+                    return shared_tf.static_cache[key]
+                shared_tf.static_cache_misses += 1
+        if static or stamp is None:
+            stamp = rospy.Time()
+        transform = self.tfBuffer.lookup_transform(target_frame, source_frame, stamp, rospy.Duration(timeout))
+        m = transform_to_matrix(transform)
+        if static:
+            with shared_tf.static_lock:
+                if (target_frame in shared_tf.static_frames and source_frame in shared_tf.static_frames and
+                        not self.in_grace_period(target_frame) and not self.in_grace_period(source_frame)):
+                    shared_tf.static_cache[key] = m
+        return m
+
+    def in_grace_period(self, frame_id):
+        """
+        Has to be called with static_lock.
+        :return: True if frame_id was invalidated less than static_cache_grace ago
+        """
+        invalidated = self.shared_tf.invalidated_frames.get(frame_id)
+        if invalidated is None:
+            return False
+        if rospy.get_rostime() - invalidated < self.shared_tf.static_cache_grace:
+            return True
+        del self.shared_tf.invalidated_frames[frame_id]
+        return False
+
+    def transform_poses(self, target_frame, poses, positions_only=False, via=None, timeout=2.0):
+        """
+        Transforms many poses with one lookup per source frame and stamp.
+        :type poses: list of PoseStamped
+        :param positions_only: skip the orientations
+        :param via: if not None, the poses are transformed into via at their stamp and from there into target_frame
+                    with the latest transform. If via and target_frame are static, only the first transform is
+                    looked up and the second one comes from the cache.
+        :param timeout: max seconds to wait for each lookup
+        :return: Nx3 array of positions and, unless positions_only, Nx4 array of orientations [x, y, z, w]
+                 in target_frame. Rows of poses that could not be transformed are nan.
+        """
+        positions = np.array([[p.pose.position.x, p.pose.position.y, p.pose.position.z] for p in poses],
+                             dtype=float).reshape(-1, 3)
+        if not positions_only:
+            orientations = np.array([[p.pose.orientation.x, p.pose.orientation.y, p.pose.orientation.z,
+                                      p.pose.orientation.w] for p in poses], dtype=float).reshape(-1, 4)
+        groups = OrderedDict()
+        for i, p in enumerate(poses):
+            groups.setdefault((p.header.frame_id, p.header.stamp.secs, p.header.stamp.nsecs), []).append(i)
+        for (frame_id, _, _), indices in groups.items():
+            stamp = poses[indices[0]].header.stamp
+            try:
+                if via is None:
+                    m = self.lookup_matrix(target_frame, frame_id, stamp, timeout)
+                else:
+                    m = self.lookup_matrix(target_frame, via, timeout=timeout).dot(
+                        self.lookup_matrix(via, frame_id, stamp, timeout))
+            except (ExtrapolationException, LookupException, ConnectivityException) as e:
+                rospy.logwarn(e)
+                positions[indices] = np.nan
+                if not positions_only:
+                    orientations[indices] = np.nan
+                continue
+            positions[indices] = positions[indices].dot(m[:3, :3].T) + m[:3, 3]
+            if not positions_only:
+                orientations[indices] = quaternion_multiply_batch(quaternion_from_matrix(m), orientations[indices])
+        if positions_only:
+            return positions
+        return positions, orientations
+
+    def transform_batch(self, target_frame, batch, timeout=2.0):
+        """
+        Transforms all poses of batch with the latest transform.
+        :type batch: PoseBatch
+        :rtype: PoseBatch
+        """
+        m = self.lookup_matrix(target_frame, batch.frame_id, timeout=timeout)
+        return PoseBatch(target_frame,
+                         batch.positions.dot(m[:3, :3].T) + m[:3, 3],
+                         quaternion_multiply_batch(quaternion_from_matrix(m), batch.orientations))
+
     def lookup_transform(self, target_frame, source_frame):
         p = PoseStamped()
         p.header.frame_id = source_frame
         p.pose.orientation.w = 1.0
         return self.transform_pose(target_frame, p)
 
-    def add_frame_from_pose(self, name, pose_stamped):
-        with self.broadcasting_frames_lock:
-            frame = TransformStamped()
-            frame.header = pose_stamped.header
-            frame.child_frame_id = name
-            frame.transform.translation = pose_stamped.pose.position
-            frame.transform.rotation = pose_stamped.pose.orientation
-            self.broadcasting_frames.append(frame)
-
-    def start_frame_broadcasting(self):
-        self.tf_broadcaster = tf.TransformBroadcaster()
-        self.tf_timer = rospy.Timer(self.tf_frequency, self.broadcasting_cb)
+    def lookup_async(self, target_frame, source_frame, stamp=None, timeout=2.0):
+        """
+        Never blocks, the lookup is resolved by the tf listener as soon as the transform is available.
+        :param stamp: rospy.Time, None for the latest transform
+        :param timeout: seconds until the future fails with a TimeoutError
+        :return: Future of the PoseStamped of source_frame in target_frame
+        """
+        if stamp is None:
+            stamp = rospy.Time()
+        deadline = rospy.get_rostime() + rospy.Duration(timeout)
+        return self.shared_tf.add_pending_lookup(PendingLookup(target_frame, source_frame, stamp, deadline))
 
-    def broadcasting_cb(self, data):
-        with self.broadcasting_frames_lock:
-            for frame in self.broadcasting_frames:
-                frame.header.stamp = rospy.get_rostime()
-                self.tf_broadcaster.sendTransformMessage(frame)
+    def transform_async(self, target_frame, pose, timeout=2.0):
+        """
+        Like lookup_async, but transforms pose at its stamp.
+        :type pose: PoseStamped
+        :return: Future of the PoseStamped in target_frame
+        """
+        deadline = rospy.get_rostime() + rospy.Duration(timeout)
+        return self.shared_tf.add_pending_lookup(PendingLookup(target_frame, pose.header.frame_id, pose.header.stamp,
+                                                               deadline, pose))
 
-    def broadcast_static_frame(self, name, pose_stamped):
+    def lookup_transforms(self, target_frame, source_frames, timeout=2.0):
+        """
+        Looks up the latest transforms of many frames at once, with one timeout for all of them.
+        :return: list of PoseStamped of the source frames in target_frame, None if a frame could not be looked up
+        """
+        futures = [self.lookup_async(target_frame, source_frame, timeout=timeout) for source_frame in source_frames]
+        wait_all(futures, timeout)
+        poses = []
+        for future in futures:
+            try:
+                poses.append(future.result(0))
+            except (ExtrapolationException, LookupException, ConnectivityException, TimeoutError) as e:
+                rospy.logwarn(e)
+                poses.append(None)
+        return poses
+
+    def pose_to_frame(self, name, pose_stamped):
         frame = TransformStamped()
         frame.header = pose_stamped.header
         frame.child_frame_id = name
         frame.transform.translation = pose_stamped.pose.position
         frame.transform.rotation = pose_stamped.pose.orientation
-        self.tf_static.sendTransform(frame)
+        return frame
+
+    def same_transform(self, a, b):
+        ta, tb = a.transform.translation, b.transform.translation
+        ra, rb = a.transform.rotation, b.transform.rotation
+        return (a.header.frame_id == b.header.frame_id and
+                (ta.x, ta.y, ta.z, ra.x, ra.y, ra.z, ra.w) == (tb.x, tb.y, tb.z, rb.x, rb.y, rb.z, rb.w))
+
+    def add_frame_from_pose(self, name, pose_stamped, static=False):
+        """
+        Adds or updates the frame name.
+        :param static: if True, the frame is only sent on /tf_static, otherwise it is broadcasted on /tf by
+                       start_frame_broadcasting. tf2 buffers keep the type of a frame they have seen once,
+                       therefore the first call decides it for good.
+        """
+        frame = self.pose_to_frame(name, pose_stamped)
+        with self.broadcasting_frames_lock:
+            old_frame = self.broadcasting_frames.get(name)
+            if old_frame is not None:
+                if self.frame_is_static[name] != static:
+                    rospy.logwarn('frame {} was added with static={}, ignoring static={}'.format(
+                        name, self.frame_is_static[name], static))
+                    static = self.frame_is_static[name]
+                if self.same_transform(old_frame, frame):
+                    return
+            self.broadcasting_frames[name] = frame
+            self.frame_is_static[name] = static
+            if static:
+                self.shared_tf.set_static_transform(frame)
+
+    def remove_frame(self, name):
+        with self.broadcasting_frames_lock:
+            if self.broadcasting_frames.pop(name, None) is not None:
+                if self.frame_is_static.pop(name):
+                    self.shared_tf.remove_static_transform(name)
+
+    def start_frame_broadcasting(self, rate=None):
+        """
+        :param rate: broadcasting frequency in Hz, 1 if None
+        """
+        if rate is not None:
+            self.tf_frequency = rospy.Duration(1. / rate)
+        self.tf_pub = rospy.Publisher('/tf', TFMessage, queue_size=10)
+        self.tf_timer = rospy.Timer(self.tf_frequency, self.broadcasting_cb)
+
+    def broadcasting_cb(self, data):
+        with self.broadcasting_frames_lock:
+            now = rospy.get_rostime()
+            msg = TFMessage()
+            for name, frame in self.broadcasting_frames.items():
+                if not self.frame_is_static[name]:
+                    frame.header.stamp = now
+                    msg.transforms.append(frame)
+            if len(msg.transforms) > 0:
+                self.tf_pub.publish(msg)
+
+    def broadcast_static_frame(self, name, pose_stamped):
+        self.shared_tf.set_static_transform(self.pose_to_frame(name, pose_stamped))
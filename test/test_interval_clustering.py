@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import json
+import os
+import unittest
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+from refills_first_review.interval_clustering import IntervalClustering
+
+# generated floors in the format of ~separator_detections_path, not recorded detections
+DETECTIONS = os.path.join(os.path.dirname(__file__), 'data', 'synthetic_separator_detections.json')
+
+
+def load_floors():
+    with open(DETECTIONS) as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+
+def dbscan_labels(data, weights, max_dist, min_samples, x_only=False):
+    if x_only:
+        data = np.concatenate([data[:, :1], np.zeros_like(data[:, 1:])], axis=1)
+    return DBSCAN(eps=max_dist, min_samples=min_samples).fit(data, sample_weight=weights).labels_
+
+
+def dbscan_on_x(data, weights, max_dist, min_samples):
+    """
+    :return: Nx3 weighted mean positions and N weights of the clusters that DBSCAN finds on the x coordinates
+    """
+    labels = dbscan_labels(data, weights, max_dist, min_samples, x_only=True)
+    clusters = []
+    for label in np.unique(labels):
+        if label != -1:
+            mask = labels == label
+            clusters.append((np.average(data[mask], axis=0, weights=weights[mask]), weights[mask].sum()))
+    clusters.sort(key=lambda x: x[0][0])
+    return np.array([c[0] for c in clusters]).reshape(-1, 3), np.array([c[1] for c in clusters])
+
+
+def interval_clustering(data, weights, max_dist, min_samples):
+    clustering = IntervalClustering(max_dist, min_samples)
+    for position, weight in zip(data, weights):
+        clustering.add(position, weight)
+    clusters = clustering.get_clusters()
+    return np.array([c[0] for c in clusters]).reshape(-1, 3), np.array([c[1] for c in clusters])
+
+
+class TestIntervalClustering(unittest.TestCase):
+    def assert_equivalent(self, data, weights, max_dist, min_samples):
+        positions, cluster_weights = interval_clustering(data, weights, max_dist, min_samples)
+        expected_positions, expected_weights = dbscan_on_x(data, weights, max_dist, min_samples)
+        self.assertEqual(len(positions), len(expected_positions))
+        np.testing.assert_allclose(positions, expected_positions, atol=1e-9)
+        np.testing.assert_allclose(cluster_weights, expected_weights)
+
+    def test_synthetic_detections(self):
+        for floor in load_floors():
+            data = np.array(floor['detections'], dtype=float)
+            weights = np.array(floor['weights'], dtype=float)
+            for min_samples in [1, 3, 6]:
+                self.assert_equivalent(data, weights, floor['max_dist'], min_samples)
+
+    def test_difference_to_dbscan_on_positions(self):
+        """
+        DBSCAN on the positions, as used by ~separator_clustering=dbscan, can only split the clusters of the
+        x coordinates, because the x distance of two detections is never larger than their distance.
+        """
+        for floor in load_floors():
+            data = np.array(floor['detections'], dtype=float)
+            weights = np.array(floor['weights'], dtype=float)
+            x_labels = dbscan_labels(data, weights, floor['max_dist'], 1, x_only=True)
+            xyz_labels = dbscan_labels(data, weights, floor['max_dist'], 1)
+            for label in np.unique(xyz_labels):
+                self.assertEqual(len(np.unique(x_labels[xyz_labels == label])), 1)
+            positions, _ = interval_clustering(data, weights, floor['max_dist'], 1)
+            self.assertLessEqual(len(positions), len(np.unique(xyz_labels)))
+
+    def test_insertion_order(self):
+        floor = load_floors()[0]
+        data = np.array(floor['detections'], dtype=float)
+        weights = np.array(floor['weights'], dtype=float)
+        order = np.random.RandomState(0).permutation(len(data))
+        for min_samples in [1, 3]:
+            a = interval_clustering(data, weights, floor['max_dist'], min_samples)
+            b = interval_clustering(data[order], weights[order], floor['max_dist'], min_samples)
+            np.testing.assert_allclose(a[0], b[0], atol=1e-9)
+
+    def test_merge_bridges_intervals(self):
+        clustering = IntervalClustering(0.02)
+        clustering.add([0.1, 0, 0])
+        clustering.add([0.13, 0, 0])
+        self.assertEqual(len(clustering), 2)
+        clustering.add([0.115, 0, 0])
+        self.assertEqual(len(clustering), 1)
+        position, weight = clustering.get_clusters()[0]
+        self.assertAlmostEqual(position[0], 0.115)
+        self.assertEqual(weight, 3)
+
+    def test_noise_and_border_points(self):
+        data = np.array([[0.1, 0, 0], [0.11, 0, 0], [0.12, 0, 0], [0.135, 0, 0], [0.5, 0, 0]])
+        weights = np.ones(len(data))
+        self.assert_equivalent(data, weights, 0.02, 3)
+        positions, cluster_weights = interval_clustering(data, weights, 0.02, 3)
+        self.assertEqual(len(positions), 1)
+        self.assertEqual(cluster_weights[0], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()